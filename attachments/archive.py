@@ -0,0 +1,355 @@
+"""
+Exporting attachments to a tar archive and importing them again, for the
+``export_attachments`` and ``import_attachments`` commands.
+
+An archive starts with ``manifest.json`` and then holds, for every
+attachment, ``attachments/<n>.json`` with its fields immediately followed by
+``attachments/<n>/<file name>`` with its file. Both sides go through the
+archive as a stream, so it never has to fit in memory or even on disk.
+"""
+from __future__ import with_statement
+
+import Queue
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
+from datetime import datetime
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
+from django.db import connection
+from django.utils import simplejson
+
+from attachments.models import Attachment
+from attachments.utils import LRUCache, \
+    commit_on_success_unless_managed, next_free_slug, _initial_slug
+
+FORMAT_VERSION = 1
+
+# Files up to this size are spooled to the import workers in memory, bigger
+# ones through a temporary file.
+SPOOL_MAX_SIZE = 1024 * 1024
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Metadata members; files are one directory further down, so their own names
+# can't be mistaken for these.
+METADATA_RE = re.compile(r'^attachments/\d{8,}\.json$')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# Timestamps are written as TIMESTAMP_FORMAT plus microseconds by hand, as
+# strftime and strptime only know %f from Python 2.6.
+def _format_timestamp(value):
+    return '%s.%06d' % (value.strftime(TIMESTAMP_FORMAT), value.microsecond)
+
+
+def _parse_timestamp(value):
+    value, microseconds = value.split('.')
+    return datetime.strptime(value, TIMESTAMP_FORMAT).replace(
+        microsecond=int(microseconds))
+
+
+def _spooled_file():
+    # SpooledTemporaryFile is new in Python 2.6.
+    if hasattr(tempfile, 'SpooledTemporaryFile'):
+        return tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    return tempfile.TemporaryFile()
+
+
+def _add_json(tar, name, data):
+    content = simplejson.dumps(data)
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = time.time()
+    tar.addfile(info, StringIO(content))
+
+
+def _keyset(queryset, batch_size):
+    """
+    Yields lists of up to ``batch_size`` primary keys of ``queryset``.
+    """
+    last_pk = None
+    while True:
+        pks = queryset.order_by('pk')
+        if last_pk is not None:
+            pks = pks.filter(pk__gt=last_pk)
+        pks = list(pks.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        last_pk = pks[-1]
+        yield pks
+
+
+def export_archive(queryset, fileobj, mode='w|', batch_size=200):
+    """
+    Writes the attachments of the objects in ``queryset`` to ``fileobj`` as a
+    tar archive (``mode`` picks the compression). Returns how many were
+    written.
+    """
+    content_type = ContentType.objects.get_for_model(queryset.model)
+    tar = tarfile.open(fileobj=fileobj, mode=mode)
+    count = 0
+    try:
+        _add_json(tar, 'manifest.json', {
+            'format': FORMAT_VERSION,
+            'exported': _format_timestamp(datetime.now()),
+            'content_type': '%s.%s' % (content_type.app_label,
+                                       content_type.model),
+        })
+        for object_ids in _keyset(queryset, batch_size):
+            attachments = Attachment.objects.filter(
+                content_type=content_type, object_id__in=object_ids,
+            ).exclude(file='').select_related('attached_by').order_by(
+                'object_id', 'attached_timestamp', 'pk')
+            for attachment in attachments.iterator():
+                count += 1
+                _add_json(tar, 'attachments/%08d.json' % count, {
+                    'content_type': '%s.%s' % (content_type.app_label,
+                                               content_type.model),
+                    'object_id': attachment.object_id,
+                    'title': attachment.title,
+                    'slug': attachment.slug,
+                    'summary': attachment.summary,
+                    'attached_timestamp': _format_timestamp(
+                        attachment.attached_timestamp),
+                    'attached_by': attachment.attached_by.username,
+                    'file_name': attachment.file_name(),
+                    'size': attachment.size,
+                    'sha256': attachment.sha256,
+                    'mime_type': attachment.mime_type,
+                })
+                source = attachment.open_file()
+                try:
+                    info = tarfile.TarInfo('attachments/%08d/%s' % (
+                        count, attachment.file_name().encode('utf-8')))
+                    source.seek(0, os.SEEK_END)
+                    info.size = source.tell()
+                    source.seek(0)
+                    info.mtime = time.mktime(
+                        attachment.attached_timestamp.timetuple())
+                    tar.addfile(info, source)
+                finally:
+                    source.close()
+    finally:
+        tar.close()
+    return count
+
+
+class Importer(object):
+    """
+    Restores the attachments of an archive.
+
+    The main thread reads the archive and hands each file, spooled to memory
+    or a temporary file, to ``workers`` threads storing them through the
+    configured directory scheme. At most ``2 * workers`` files wait for a
+    worker. Stored attachments are inserted ``batch_size`` at a time.
+    """
+
+    def __init__(self, workers=4, batch_size=200, skip_missing=False,
+                 default_user=None, stdout=None):
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.skip_missing = skip_missing
+        self.default_user = default_user
+        self.stdout = stdout
+        self.users = LRUCache(1000)
+        self.last_object = (None, None)
+        self.queue = Queue.Queue(maxsize=2 * self.workers)
+        self.stored = Queue.Queue()
+        self.pending = []
+        self.imported = self.skipped = self.failed = 0
+
+    def warn(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message + "\n")
+
+    def _get_user(self, username):
+        def load():
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                return self.default_user
+        return self.users.get(username, load)
+
+    def _object_exists(self, content_type, object_id):
+        # Attachments are exported object by object, so remembering the last
+        # one answers most of these.
+        key = (content_type.pk, object_id)
+        if self.last_object[0] != key:
+            model = content_type.model_class()
+            # Not the default manager, which may hide rows that exist.
+            exists = model is not None and model._base_manager.filter(
+                pk=object_id).exists()
+            self.last_object = (key, exists)
+        return self.last_object[1]
+
+    def _build(self, data):
+        """
+        Returns the unsaved attachment for the metadata ``data``, or None if
+        it should be skipped.
+        """
+        try:
+            app_label, model = data['content_type'].split('.')
+            content_type = ContentType.objects.get_by_natural_key(app_label,
+                                                                  model)
+        except (ValueError, ContentType.DoesNotExist):
+            self.warn("Skipping %s: unknown content type %s"
+                      % (data['file_name'], data['content_type']))
+            return None
+        if self.skip_missing and not self._object_exists(content_type,
+                                                         data['object_id']):
+            return None
+        user = self._get_user(data['attached_by'])
+        if user is None:
+            self.warn("Skipping %s: unknown user %s"
+                      % (data['file_name'], data['attached_by']))
+            return None
+
+        attachment = Attachment(
+            title=data['title'], slug=data['slug'], summary=data['summary'],
+            attached_timestamp=_parse_timestamp(data['attached_timestamp']),
+            mime_type=data['mime_type'])
+        # Setting the content type itself (rather than its id) saves the
+        # directory scheme a query in the worker.
+        attachment.content_type = content_type
+        attachment.object_id = data['object_id']
+        attachment.attached_by = user
+        attachment._expected_sha256 = data['sha256']
+        return attachment
+
+    def _work(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                attachment, name, size, spooled = item
+                content = File(spooled, name)
+                content.size = size
+                try:
+                    attachment.file.save(name, content, save=False)
+                except Exception, e:
+                    self.stored.put((attachment, e))
+                else:
+                    self.stored.put((attachment, None))
+                finally:
+                    spooled.close()
+        finally:
+            connection.close()
+
+    def _collect(self):
+        while True:
+            try:
+                attachment, error = self.stored.get(False)
+            except Queue.Empty:
+                return
+            if error is not None:
+                self.failed += 1
+                self.warn("Could not store %s: %s" % (attachment.title,
+                                                      error))
+                continue
+            expected = attachment._expected_sha256
+            if expected and attachment.sha256 != expected:
+                self.warn("Checksum mismatch for %s (%s)"
+                          % (attachment.title, attachment.file.name))
+            self.pending.append(attachment)
+            if len(self.pending) >= self.batch_size:
+                self._insert()
+
+    def _insert(self):
+        """
+        Inserts the pending attachments, keeping their slugs unless the
+        object already has an attachment with the same one.
+        """
+        attachments, self.pending = self.pending, []
+        object_ids = {}
+        for attachment in attachments:
+            object_ids.setdefault(attachment.content_type_id, set()).add(
+                attachment.object_id)
+        taken = {}
+        for content_type_id, ids in object_ids.items():
+            rows = Attachment.objects.filter(
+                content_type=content_type_id, object_id__in=ids,
+            ).values_list('object_id', 'slug')
+            for object_id, slug in rows:
+                taken.setdefault((content_type_id, object_id), set()).add(
+                    slug)
+        slug_len = Attachment._meta.get_field('slug').max_length
+        for attachment in attachments:
+            slugs = taken.setdefault(
+                (attachment.content_type_id, attachment.object_id), set())
+            if not attachment.slug or attachment.slug in slugs:
+                # Number it like a new attachment with the same title.
+                base = _initial_slug(attachment.title or '', slug_len)
+                attachment.slug = next_free_slug(base or attachment.slug,
+                                                 slugs, slug_len)
+            slugs.add(attachment.slug)
+
+        with Attachment.objects._deleting_files_on_error(attachments):
+            with commit_on_success_unless_managed():
+                Attachment.objects._bulk_create(attachments)
+        self.imported += len(attachments)
+
+    def run(self, fileobj):
+        tar = tarfile.open(fileobj=fileobj, mode='r|*')
+        threads = [threading.Thread(target=self._work)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            self._read(tar)
+        finally:
+            for thread in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            tar.close()
+        self._collect()
+        if self.pending:
+            self._insert()
+        return self.imported
+
+    def _read(self, tar):
+        members = iter(tar)
+        try:
+            first = members.next()
+        except StopIteration:
+            first = None
+        if first is None or first.name != 'manifest.json':
+            raise ArchiveError("Not an attachment archive")
+        manifest = simplejson.loads(tar.extractfile(first).read())
+        if manifest.get('format') != FORMAT_VERSION:
+            raise ArchiveError("Unsupported archive format %r"
+                               % manifest.get('format'))
+
+        attachment = None
+        for member in members:
+            if METADATA_RE.match(member.name):
+                data = simplejson.loads(tar.extractfile(member).read())
+                attachment = self._build(data)
+                if attachment is None:
+                    self.skipped += 1
+                continue
+            if attachment is None or not member.isfile():
+                continue
+
+            spooled = _spooled_file()
+            source = tar.extractfile(member)
+            for chunk in iter(lambda: source.read(64 * 1024), ''):
+                spooled.write(chunk)
+            spooled.seek(0)
+            name = os.path.basename(member.name).decode('utf-8')
+            # Blocks while enough files are waiting for the workers.
+            self.queue.put((attachment, name, member.size, spooled))
+            attachment = None
+            self._collect()
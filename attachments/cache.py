@@ -0,0 +1,122 @@
+"""
+Caching of the attachment list of each object in Django's cache framework.
+
+Enabled by setting ``ATTACHMENT_CACHE_TIMEOUT`` to the number of seconds to
+keep lists for. Lists are stored under a key containing a per-object version
+number, so invalidating an object's list (whatever changed about it) is an
+``incr`` of that number, repeated once the change has been committed.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from attachments.utils import run_after_commit
+
+CACHE_TIMEOUT = getattr(settings, 'ATTACHMENT_CACHE_TIMEOUT', 0)
+KEY_PREFIX = getattr(settings, 'ATTACHMENT_CACHE_KEY_PREFIX', 'attachments')
+
+# Version numbers outlive the lists they stamp.
+VERSION_TIMEOUT = CACHE_TIMEOUT * 10
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(stat):
+    _stats_lock.acquire()
+    try:
+        _stats[stat] += 1
+    finally:
+        _stats_lock.release()
+
+
+def stats():
+    """
+    Returns a dictionary with the number of cache ``hits`` and ``misses`` in
+    this process.
+    """
+    _stats_lock.acquire()
+    try:
+        return dict(_stats)
+    finally:
+        _stats_lock.release()
+
+
+def reset_stats():
+    _stats_lock.acquire()
+    try:
+        for stat in _stats:
+            _stats[stat] = 0
+    finally:
+        _stats_lock.release()
+
+
+def _version_key(content_type_id, object_id):
+    return '%s:version:%s:%s' % (KEY_PREFIX, content_type_id, object_id)
+
+
+def _new_version():
+    # Start from the clock rather than 1, so that a version number evicted
+    # from the cache never comes back as one that stamped an old list.
+    return int(time.time() * 1000)
+
+
+def get_version(content_type_id, object_id):
+    key = _version_key(content_type_id, object_id)
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), VERSION_TIMEOUT)
+
+
+def invalidate(content_type_id, object_id):
+    """
+    Makes the cached attachment list of the object stale, both right away
+    and once the current transaction has been committed.
+    """
+    if not CACHE_TIMEOUT:
+        return
+    key = _version_key(content_type_id, object_id)
+    _bump(key)
+    if transaction.is_managed():
+        # Until the commit other connections still read the old list, and
+        # may cache it under the new version.
+        run_after_commit(lambda: _bump(key))
+
+
+def get_attachment_list(content_type_id, object_id, load):
+    """
+    Returns the cached attachment list of the object, calling ``load`` to get
+    it on a miss.
+    """
+    if not CACHE_TIMEOUT:
+        return list(load())
+    key = '%s:list:%s:%s:%s' % (KEY_PREFIX, content_type_id, object_id,
+                                get_version(content_type_id, object_id))
+    attachments = cache.get(key)
+    if attachments is None:
+        _count('misses')
+        attachments = list(load())
+        cache.set(key, attachments, CACHE_TIMEOUT)
+    else:
+        _count('hits')
+    return attachments
+
+
+def invalidate_attachment(sender, instance, **kwargs):
+    """
+    Signal handler invalidating the list ``instance`` belongs to.
+    """
+    invalidate(instance.content_type_id, instance.object_id)
@@ -0,0 +1,187 @@
+"""
+Finding what the ``sweep_attachments`` command removes: attachments of
+objects that no longer exist, derivatives of files no attachment uses any
+more, stored files nothing refers to and chunked uploads nobody finished.
+
+Everything is read in batches (and storage listings one directory at a time)
+so memory use stays the same however many attachments and files there are.
+"""
+from __future__ import with_statement
+
+import logging
+import os
+import posixpath
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+
+from attachments.models import Attachment, Blob, ChunkedUpload, Derivative, \
+    UPLOAD_STAGING_DIR
+from attachments.storage import CONTENT_ADDRESSED
+from attachments.utils import commit_on_success_unless_managed
+
+logger = logging.getLogger('attachments.cleanup')
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def dangling_attachments(batch_size=500):
+    """
+    Yields lists of the ids of attachments whose content object doesn't
+    exist any more.
+    """
+    content_type_ids = Attachment.objects.order_by().values_list(
+        'content_type', flat=True).distinct()
+    for content_type_id in list(content_type_ids):
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            # The model is gone, not necessarily its table; leave these be.
+            logger.warning("Skipping attachments of content type %s, which "
+                           "has no model", content_type_id)
+            continue
+        last_pk = 0
+        while True:
+            rows = list(Attachment.objects.filter(
+                content_type=content_type_id, pk__gt=last_pk,
+            ).order_by('pk').values_list('pk', 'object_id')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            # The default manager may hide rows of objects that still exist.
+            existing = set(model._base_manager.filter(
+                pk__in=set(object_id for pk, object_id in rows),
+            ).values_list('pk', flat=True))
+            dangling = [pk for pk, object_id in rows
+                        if object_id not in existing]
+            if dangling:
+                yield dangling
+
+
+def stale_derivatives(batch_size=500):
+    """
+    Yields lists of derivatives whose original file no attachment uses.
+    """
+    last_pk = 0
+    while True:
+        derivatives = list(Derivative.objects.filter(
+            pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not derivatives:
+            break
+        last_pk = derivatives[-1].pk
+        used = set(Attachment.objects.filter(
+            file__in=set(d.source for d in derivatives),
+        ).values_list('file', flat=True))
+        stale = [d for d in derivatives if d.source not in used]
+        if stale:
+            yield stale
+
+
+def walk_storage(storage, path):
+    """
+    Yields the names of all files below ``path`` in ``storage``, listing one
+    directory at a time.
+    """
+    if not storage.exists(path):
+        return
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield posixpath.join(path, name)
+    for directory in directories:
+        for name in walk_storage(storage, posixpath.join(path, directory)):
+            yield name
+
+
+def _old_enough(storage, name, min_age):
+    if not min_age:
+        return True
+    try:
+        return datetime.now() - storage.modified_time(name) >= min_age
+    except NotImplementedError:
+        return True
+
+
+def orphaned_files(storage, paths, batch_size=500, min_age=None):
+    """
+    Yields lists of the names of files below ``paths`` in ``storage`` that
+    no attachment, derivative or blob refers to.
+
+    Files younger than the ``min_age`` timedelta are left alone; they may
+    belong to an upload whose attachment hasn't been committed yet.
+    """
+    for path in paths:
+        for names in _batches(walk_storage(storage, path), batch_size):
+            used = set(Attachment.objects.filter(
+                file__in=names).values_list('file', flat=True))
+            used.update(Derivative.objects.filter(
+                file_name__in=names).values_list('file_name', flat=True))
+            if CONTENT_ADDRESSED:
+                used.update(Blob.objects.filter(
+                    name__in=names).values_list('name', flat=True))
+            orphans = [name for name in names if name not in used
+                       and _old_enough(storage, name, min_age)]
+            if orphans:
+                yield orphans
+
+
+def delete_attachments(pks):
+    """
+    Deletes the attachments with the ids ``pks``; their files go once that
+    is committed.
+    """
+    with commit_on_success_unless_managed():
+        Attachment.objects.filter(pk__in=pks).delete()
+
+
+def _modified(path):
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(path))
+    except OSError:
+        return None
+
+
+def abandoned_uploads(max_age, batch_size=500):
+    """
+    Yields lists of the chunked uploads that were started, and last had a
+    chunk appended, longer than the ``max_age`` timedelta ago.
+    """
+    cutoff = datetime.now() - max_age
+    last_pk = 0
+    while True:
+        uploads = list(ChunkedUpload.objects.filter(
+            pk__gt=last_pk, started__lt=cutoff).order_by('pk')[:batch_size])
+        if not uploads:
+            break
+        last_pk = uploads[-1].pk
+        abandoned = [upload for upload in uploads
+                     if (_modified(upload.staging_path) or cutoff) <= cutoff]
+        if abandoned:
+            yield abandoned
+
+
+def orphaned_staging_files(max_age, batch_size=500):
+    """
+    Yields lists of the paths of files in ``UPLOAD_STAGING_DIR`` older than
+    the ``max_age`` timedelta that belong to no chunked upload, eg. because
+    the process finishing the upload died before removing its file.
+    """
+    if not os.path.isdir(UPLOAD_STAGING_DIR):
+        return
+    cutoff = datetime.now() - max_age
+    for names in _batches(os.listdir(UPLOAD_STAGING_DIR), batch_size):
+        used = set(ChunkedUpload.objects.filter(
+            upload_id__in=names).values_list('upload_id', flat=True))
+        paths = [os.path.join(UPLOAD_STAGING_DIR, name) for name in names
+                 if name not in used]
+        orphans = [path for path in paths
+                   if (_modified(path) or cutoff) <= cutoff]
+        if orphans:
+            yield orphans
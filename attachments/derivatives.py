@@ -0,0 +1,197 @@
+"""
+Thumbnails and previews of attachment files, made when first asked for.
+
+``ATTACHMENT_DERIVATIVE_SIZES`` maps the name of each kind of derivative to
+the ``(width, height)`` box it is scaled down to fit. Derivatives are stored
+next to their original as ``<original>.<name>.png`` and recorded as
+``Derivative`` rows. Once they take up more than
+``ATTACHMENT_DERIVATIVE_MAX_BYTES`` in total, the least recently used ones are
+removed again.
+
+``ATTACHMENT_DERIVATIVE_RENDERER`` names the callable making them: it takes
+the open original file and the size, and returns the PNG data. The default
+one uses PIL.
+"""
+from __future__ import with_statement
+
+import threading
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+
+from attachments.models import Derivative, derivative_storage
+from attachments.utils import get_callable_from_string, \
+    commit_on_success_unless_managed
+
+DERIVATIVE_SIZES = getattr(settings, 'ATTACHMENT_DERIVATIVE_SIZES', {
+    'thumbnail': (128, 128),
+    'preview': (800, 800),
+})
+DERIVATIVE_MAX_BYTES = getattr(settings, 'ATTACHMENT_DERIVATIVE_MAX_BYTES',
+                               512 * 1024 * 1024)
+DERIVATIVE_RENDERER = getattr(settings, 'ATTACHMENT_DERIVATIVE_RENDERER',
+                              'attachments.derivatives.render_image')
+
+# How stale ``last_accessed`` may get before a hit writes it again.
+ACCESS_RESOLUTION = timedelta(minutes=5)
+
+
+class DerivativeError(Exception):
+    pass
+
+
+def render_image(source, size):
+    """
+    Scales the image in the file-like ``source`` down to fit ``size`` and
+    returns it as PNG data.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise DerivativeError("PIL is needed to make image derivatives")
+    try:
+        image = Image.open(source)
+        image.thumbnail(size, Image.ANTIALIAS)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        output = StringIO()
+        image.save(output, 'PNG')
+    except (IOError, ValueError), e:
+        raise DerivativeError("Can't make a derivative: %s" % e)
+    return output.getvalue()
+
+
+_renderer_cache = {}
+
+def get_renderer():
+    try:
+        return _renderer_cache['renderer']
+    except KeyError:
+        renderer = get_callable_from_string(DERIVATIVE_RENDERER)
+        _renderer_cache['renderer'] = renderer
+        return renderer
+
+
+# One lock per derivative being made, so that concurrent requests for the
+# same one in this process wait for it instead of making it again.
+_locks = {}
+_locks_lock = threading.Lock()
+
+def _acquire(key):
+    _locks_lock.acquire()
+    try:
+        lock, waiting = _locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _locks[key] = (lock, waiting + 1)
+    finally:
+        _locks_lock.release()
+    lock.acquire()
+    return lock
+
+
+def _release(key, lock):
+    lock.release()
+    _locks_lock.acquire()
+    try:
+        lock, waiting = _locks[key]
+        if waiting == 1:
+            del _locks[key]
+        else:
+            _locks[key] = (lock, waiting - 1)
+    finally:
+        _locks_lock.release()
+
+
+def _touch(derivative):
+    now = datetime.now()
+    if now - derivative.last_accessed > ACCESS_RESOLUTION:
+        Derivative.objects.filter(pk=derivative.pk).update(last_accessed=now)
+        derivative.last_accessed = now
+
+
+def _existing(source, name):
+    try:
+        return Derivative.objects.get(source=source, name=name)
+    except Derivative.DoesNotExist:
+        return None
+
+
+def get_derivative(attachment, name):
+    """
+    Returns the ``Derivative`` called ``name`` of the file of ``attachment``,
+    making it first if need be. Raises ``DerivativeError`` if it can't be
+    made, eg. because the file isn't an image.
+    """
+    try:
+        size = DERIVATIVE_SIZES[name]
+    except KeyError:
+        raise DerivativeError("Unknown derivative %r" % name)
+    source = attachment.file.name
+
+    derivative = _existing(source, name)
+    if derivative is None:
+        key = (source, name)
+        lock = _acquire(key)
+        try:
+            derivative = _existing(source, name)
+            if derivative is None:
+                derivative = _make(attachment, source, name, size)
+        finally:
+            _release(key, lock)
+    _touch(derivative)
+    return derivative
+
+
+def _make(attachment, source, name, size):
+    original = attachment.open_file()
+    try:
+        data = get_renderer()(original, size)
+    finally:
+        original.close()
+
+    file_name = derivative_storage.save('%s.%s.png' % (source, name),
+                                        ContentFile(data))
+    derivative = Derivative(source=source, name=name, file_name=file_name,
+                            size=len(data))
+    with commit_on_success_unless_managed():
+        sid = transaction.savepoint()
+        try:
+            derivative.save()
+        except IntegrityError:
+            # Another process made it at the same time; use theirs.
+            transaction.savepoint_rollback(sid)
+            derivative_storage.delete(file_name)
+            return Derivative.objects.get(source=source, name=name)
+        transaction.savepoint_commit(sid)
+        evict(keep=derivative)
+    return derivative
+
+
+def evict(max_bytes=None, keep=None):
+    """
+    Deletes the least recently used derivatives, other than ``keep``, until
+    they take up no more than ``max_bytes`` (``DERIVATIVE_MAX_BYTES`` by
+    default). Returns how many were deleted.
+    """
+    if max_bytes is None:
+        max_bytes = DERIVATIVE_MAX_BYTES
+    if not max_bytes:
+        return 0
+    total = Derivative.objects.aggregate(total=Sum('size'))['total'] or 0
+    deleted = 0
+    if total > max_bytes:
+        derivatives = Derivative.objects.order_by('last_accessed', 'pk')
+        if keep is not None:
+            derivatives = derivatives.exclude(pk=keep.pk)
+        for derivative in derivatives:
+            if total <= max_bytes:
+                break
+            derivative.delete()
+            total -= derivative.size
+            deleted += 1
+    return deleted
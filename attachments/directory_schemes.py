@@ -1,8 +1,39 @@
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.test.signals import setting_changed
 
+import hashlib
 import os.path
 
+from utils import get_callable_from_string
+
+_scheme_cache = {}
+
+def get_directory_scheme():
+    """
+    Returns the directory scheme callable named by the ATTACHMENT_STORAGE_DIR
+    setting, or ``by_app`` if it isn't set.
+
+    The setting is only resolved once. A setting that doesn't name a callable
+    raises ImproperlyConfigured rather than falling back to ``by_app``.
+    """
+    try:
+        return _scheme_cache['scheme']
+    except KeyError:
+        path = getattr(settings, 'ATTACHMENT_STORAGE_DIR', None)
+        if path:
+            scheme = get_callable_from_string(path)
+        else:
+            scheme = by_app
+        _scheme_cache['scheme'] = scheme
+        return scheme
+
+def _clear_scheme_cache(sender, setting, **kwargs):
+    if setting == 'ATTACHMENT_STORAGE_DIR':
+        _scheme_cache.clear()
+
+setting_changed.connect(_clear_scheme_cache)
+
 def site_based(attachment, filename):
     site_name = getattr(settings, "SITE_NAME", 'default')
     model_string = '%s_%s' % (
@@ -13,7 +44,7 @@ def site_based(attachment, filename):
         'attachments',
         site_name,
         model_string,
-        str(attachment.content_object.pk),
+        str(attachment.object_id),
         filename
     )
 
@@ -29,9 +60,43 @@ def by_app(attachment, filename):
     return os.path.join(
         'attachments',
         model_string,
-        str(attachment.content_object.pk),
+        str(attachment.object_id),
         filename
     )
 
 def one_folder(attachment, filename):
-    return os.path.join('attachments', filename)
\ No newline at end of file
+    return os.path.join('attachments', filename)
+
+def sharded(attachment, filename):
+    """
+    Like ``by_app``, but with the object's directory inside one of 256
+    subdirectories picked by hashing its id, so no single directory ends up
+    with an entry for every object:
+    attachments/<app_label>_<model>/<sha1(object_id)[:2]>/<object_id>/
+    """
+    model_string = '%s_%s' % (
+        attachment.content_type.app_label,
+        attachment.content_type.model.lower()
+    )
+    object_id = str(attachment.object_id)
+    return os.path.join(
+        'attachments',
+        model_string,
+        hashlib.sha1(object_id).hexdigest()[:2],
+        object_id,
+        filename
+    )
+
+def sharded_by_content_type(attachment, filename):
+    """
+    attachments/<content_type_id>/<sha1(object_id)[:2]>/<object_id>/, which
+    keeps working when models are renamed or moved between apps.
+    """
+    object_id = str(attachment.object_id)
+    return os.path.join(
+        'attachments',
+        str(attachment.content_type_id),
+        hashlib.sha1(object_id).hexdigest()[:2],
+        object_id,
+        filename
+    )
@@ -0,0 +1,232 @@
+"""
+Helpers for serving attachment files and their derivatives, used by the
+``download_attachment`` and ``download_derivative`` views.
+
+Files are streamed in ``ATTACHMENT_DOWNLOAD_CHUNK_SIZE`` byte chunks and a
+single ``Range`` of bytes may be requested. Setting
+``ATTACHMENT_SENDFILE_HEADER`` to ``'X-Sendfile'`` (Apache, lighttpd) or
+``'X-Accel-Redirect'`` (nginx) hands the transfer over to the web server
+instead, in which case ``ATTACHMENT_SENDFILE_URL_PREFIX`` is prepended to the
+file name for ``X-Accel-Redirect``. Files of storages without local paths are
+still streamed.
+
+For storages that serve files themselves, eg. from a CDN or with signed S3
+URLs, ``ATTACHMENT_DOWNLOAD_REDIRECT = True`` redirects downloads to the
+file's URL, so that slow transfers don't keep a worker busy.
+"""
+import mimetypes
+import re
+import time
+import unicodedata
+import urllib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, \
+    HttpResponseRedirect
+from django.utils.encoding import force_unicode
+from django.utils.http import http_date, parse_http_date_safe
+
+from attachments.models import derivative_storage
+
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'ATTACHMENT_DOWNLOAD_CHUNK_SIZE',
+                              64 * 1024)
+SENDFILE_HEADER = getattr(settings, 'ATTACHMENT_SENDFILE_HEADER', None)
+SENDFILE_URL_PREFIX = getattr(settings, 'ATTACHMENT_SENDFILE_URL_PREFIX',
+                              '/protected/')
+DOWNLOAD_REDIRECT = getattr(settings, 'ATTACHMENT_DOWNLOAD_REDIRECT', False)
+DERIVATIVE_MAX_AGE = getattr(settings, 'ATTACHMENT_DERIVATIVE_MAX_AGE',
+                             365 * 24 * 60 * 60)
+
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Compressed files are served as they are stored, so they get the type of
+# the compression rather than a Content-Encoding that clients would undo.
+ENCODING_TYPES = {
+    'gzip': 'application/gzip',
+    'bzip2': 'application/x-bzip2',
+    'compress': 'application/x-compress',
+    'xz': 'application/x-xz',
+}
+
+
+def parse_range_header(header, size):
+    """
+    Parses a ``Range`` header for a file of ``size`` bytes.
+
+    Returns a ``(start, end)`` tuple (``end`` inclusive), ``None`` if the
+    header is missing or isn't something we support (several ranges, other
+    units), in which case the whole file should be sent, or raises
+    ``ValueError`` if the range can't be satisfied.
+    """
+    match = range_re.match(header.replace(' ', '')) if header else None
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # A suffix range: the last ``end`` bytes.
+        length = int(end)
+        if not length:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end:
+        end = min(int(end), size - 1)
+    else:
+        end = size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def file_iterator(file, start=0, length=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Yields ``length`` bytes (or everything) of ``file`` from offset ``start``
+    in ``chunk_size`` pieces, closing the file when done.
+    """
+    try:
+        if start:
+            file.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                data = file.read(chunk_size)
+            else:
+                data = file.read(min(chunk_size, remaining))
+                remaining -= len(data)
+            if not data:
+                break
+            yield data
+    finally:
+        file.close()
+
+
+def attachment_etag(attachment, size):
+    mtime = int(time.mktime(attachment.attached_timestamp.timetuple()))
+    return '"%s-%s-%s"' % (attachment.pk, mtime, size)
+
+
+def serve_attachment(request, attachment, as_attachment=True):
+    """
+    Returns a response for the file of ``attachment``, honouring conditional
+    (``If-None-Match``, ``If-Modified-Since``) and ``Range``/``If-Range``
+    request headers, or redirects to the file if ``DOWNLOAD_REDIRECT`` is
+    set.
+    """
+    if DOWNLOAD_REDIRECT:
+        return HttpResponseRedirect(attachment.file.url)
+    storage, name = attachment.file.storage, attachment.file.name
+    size = storage.size(name)
+    mtime = int(time.mktime(attachment.attached_timestamp.timetuple()))
+    if as_attachment:
+        filename = attachment.file_name()
+    else:
+        filename = None
+    return serve_file(request, storage, name, size, mtime,
+                      attachment_etag(attachment, size), filename)
+
+
+def serve_derivative(request, derivative):
+    """
+    Returns a response for the file of ``derivative``, cacheable for
+    ``ATTACHMENT_DERIVATIVE_MAX_AGE`` seconds.
+    """
+    mtime = int(time.mktime(derivative.created.timetuple()))
+    etag = '"d%s-%s-%s"' % (derivative.pk, mtime, derivative.size)
+    response = serve_file(request, derivative_storage, derivative.file_name,
+                          derivative.size, mtime, etag)
+    response['Cache-Control'] = 'private, max-age=%d' % DERIVATIVE_MAX_AGE
+    return response
+
+
+def serve_file(request, storage, name, size, mtime, etag, filename=None):
+    """
+    Returns a response for the file ``name`` in ``storage``, served as a
+    download called ``filename`` if given.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match:
+        etags = [e.strip() for e in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            return HttpResponseNotModified()
+    elif if_modified_since and if_modified_since >= mtime:
+        return HttpResponseNotModified()
+
+    # Only honour a Range if the client's copy (named by If-Range) is current.
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if (not if_range or if_range == etag
+            or parse_http_date_safe(if_range) == mtime):
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'),
+                                            size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+
+    content_type, encoding = mimetypes.guess_type(name)
+    if encoding:
+        content_type = ENCODING_TYPES.get(encoding, 'application/octet-stream')
+    content_type = content_type or 'application/octet-stream'
+
+    response = None
+    if SENDFILE_HEADER:
+        response = sendfile_response(storage, name, content_type)
+    if response is None and byte_range:
+        start, end = byte_range
+        response = HttpResponse(
+            file_iterator(storage.open(name, 'rb'), start, end - start + 1),
+            content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+    elif response is None:
+        response = HttpResponse(file_iterator(storage.open(name, 'rb')),
+                                content_type=content_type)
+        response['Content-Length'] = str(size)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    if filename:
+        response['Content-Disposition'] = content_disposition(filename)
+    return response
+
+
+def sendfile_response(storage, name, content_type):
+    """
+    Returns a response handing the file ``name`` over to the web server with
+    ``SENDFILE_HEADER``, which then deals with ranges itself, or None if the
+    file isn't on the local filesystem (eg. in S3).
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if SENDFILE_HEADER.lower() == 'x-accel-redirect':
+        response[SENDFILE_HEADER] = SENDFILE_URL_PREFIX + name
+    else:
+        response[SENDFILE_HEADER] = path
+    return response
+
+
+def content_disposition(filename):
+    """
+    Returns a ``Content-Disposition`` header value offering a download
+    called ``filename``. Names that aren't plain ASCII are also given as an
+    RFC 5987 ``filename*``, with an ASCII approximation for older clients.
+    """
+    filename = force_unicode(filename, errors='replace')
+    fallback = unicodedata.normalize('NFKD', filename).encode('ascii',
+                                                              'ignore')
+    fallback = ''.join(c for c in fallback
+                       if ' ' <= c <= '~' and c not in '"\\') or 'download'
+    value = 'attachment; filename="%s"' % fallback
+    if fallback != filename:
+        value += "; filename*=UTF-8''%s" % urllib.quote(
+            filename.encode('utf-8'), safe='')
+    return value
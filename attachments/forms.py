@@ -1,8 +1,20 @@
+from __future__ import with_statement
+
+import logging
+import os
+
 from django import forms
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 
-from attachments.models import Attachment
+from attachments.models import Attachment, ChunkedUpload
+
+# The most files a MultipleAttachmentForm accepts at once.
+MAX_FILES_PER_UPLOAD = getattr(settings, 'ATTACHMENT_MAX_FILES_PER_UPLOAD',
+                               500)
+
+logger = logging.getLogger('attachments.forms')
 
 
 class AttachmentForm(forms.ModelForm):
@@ -34,4 +46,112 @@ class AttachmentEditForm(forms.ModelForm):
 
     class Meta:
         model = Attachment
-        exclude = ('content_type', 'object_id', 'attached_by')
\ No newline at end of file
+        exclude = ('content_type', 'object_id', 'attached_by')
+
+
+class ChunkedUploadForm(forms.ModelForm):
+    """
+    Starts a chunked upload of a file of ``size`` bytes.
+    """
+
+    def clean_filename(self):
+        # The name is passed to the directory scheme as it is, so it must
+        # not be able to climb out of the attachment's directory.
+        filename = self.cleaned_data['filename'].replace('\\', '/')
+        storage = Attachment._meta.get_field('file').storage
+        filename = storage.get_valid_name(os.path.basename(filename))
+        if filename.strip('.') == '':
+            raise forms.ValidationError(_("Enter a valid file name."))
+        return filename
+
+    def clean_size(self):
+        # An empty file has no chunks to send, so the upload could never be
+        # finished.
+        size = self.cleaned_data['size']
+        if size < 1:
+            raise forms.ValidationError(_("The file is empty."))
+        return size
+
+    def save(self, content_object, user, *args, **kwargs):
+        self.instance.content_type = ContentType.objects.get_for_model(
+            content_object)
+        self.instance.object_id = content_object.pk
+        self.instance.user = user
+
+        return super(ChunkedUploadForm, self).save(*args, **kwargs)
+
+    class Meta:
+        model = ChunkedUpload
+        fields = ('filename', 'size', 'title', 'summary')
+
+
+class MultipleFileInput(forms.ClearableFileInput):
+    """
+    A file input for selecting several files at once.
+    """
+
+    def __init__(self, attrs=None):
+        attrs = dict(attrs or {}, multiple='multiple')
+        super(MultipleFileInput, self).__init__(attrs)
+
+    def value_from_datadict(self, data, files, name):
+        return files.getlist(name)
+
+
+class MultipleFileField(forms.FileField):
+    widget = MultipleFileInput
+
+    def clean(self, data, initial=None):
+        if not data:
+            if self.required:
+                raise forms.ValidationError(self.error_messages['required'])
+            return []
+        if len(data) > MAX_FILES_PER_UPLOAD:
+            raise forms.ValidationError(
+                _("Upload at most %d files at once.") % MAX_FILES_PER_UPLOAD)
+        single = forms.FileField(max_length=self.max_length)
+        return [single.clean(f) for f in data]
+
+
+class MultipleAttachmentForm(forms.Form):
+    """
+    Attaches several files at once, each titled with the name it was
+    uploaded with.
+    """
+    files = MultipleFileField(label=_("files"))
+    summary = forms.CharField(label=_("summary"), widget=forms.Textarea,
+                              required=False)
+
+    def save(self, content_object, user):
+        """
+        Stores the files one after the other, then creates the attachments
+        for those that could be stored in a single transaction.
+
+        Returns a list with a dictionary for each file, in the order they
+        were uploaded, with the ``name`` of the file and either the
+        ``attachment`` or the ``error`` that prevented storing it.
+        """
+        content_type = ContentType.objects.get_for_model(content_object)
+        results = []
+        attachments = []
+        for uploaded in self.cleaned_data['files']:
+            result = {'name': uploaded.name}
+            attachment = Attachment(content_type=content_type,
+                                    object_id=content_object.pk,
+                                    attached_by=user, title=uploaded.name[:200],
+                                    summary=self.cleaned_data['summary'])
+            try:
+                # Large uploads are read from their temporary file in chunks.
+                attachment.file.save(uploaded.name, uploaded, save=False)
+            except (IOError, OSError), e:
+                logger.exception("Storing %s failed", uploaded.name)
+                result['error'] = unicode(_("The file could not be stored."))
+            else:
+                result['attachment'] = attachment
+                attachments.append(attachment)
+            results.append(result)
+
+        with Attachment.objects._deleting_files_on_error(attachments):
+            Attachment.objects.bulk_create_for_object(content_object,
+                                                      attachments)
+        return results
@@ -0,0 +1,148 @@
+"""
+Timing of attachment operations.
+
+With ``ATTACHMENT_INSTRUMENTATION = True`` the instrumented operations (the
+``AttachmentManager`` methods, ``Attachment.save`` and ``copy``, storage
+writes, remote fetches and the views) send an ``operation_timed`` signal
+with the operation's ``name``, how many ``seconds`` it took, how many
+``queries`` it made and whether it ``failed``. Queries are only counted when
+Django records them (``DEBUG`` or ``connection.use_debug_cursor``);
+otherwise ``queries`` is None. Nested operations are timed separately, each
+including what it called.
+
+``collector`` keeps a histogram of the timings of every operation in this
+process; ``collector.dumps()`` returns them as JSON. When instrumentation is
+off, instrumented operations only pay for checking ``ENABLED``.
+"""
+from __future__ import with_statement
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.dispatch import Signal
+from django.utils import simplejson
+
+ENABLED = getattr(settings, 'ATTACHMENT_INSTRUMENTATION', False)
+
+# Upper bounds (in seconds) of the histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+operation_timed = Signal(providing_args=['name', 'seconds', 'queries',
+                                         'failed'])
+
+
+def _query_count():
+    if settings.DEBUG or connection.use_debug_cursor:
+        return len(connection.queries)
+    return None
+
+
+@contextmanager
+def timed(name):
+    """
+    Times the block as the operation ``name``.
+    """
+    if not ENABLED:
+        yield
+        return
+    queries = _query_count()
+    started = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        seconds = time.time() - started
+        if queries is not None:
+            queries = _query_count() - queries
+        operation_timed.send(sender=None, name=name, seconds=seconds,
+                             queries=queries, failed=failed)
+
+
+def instrumented(name):
+    """
+    Decorator timing each call of the function as the operation ``name``.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class HistogramCollector(object):
+    """
+    Collects ``operation_timed`` signals into a histogram per operation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, sender, name, seconds, queries, failed, **kwargs):
+        self.lock.acquire()
+        try:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = {
+                    'count': 0, 'failed': 0, 'total_seconds': 0.0,
+                    'min_seconds': seconds, 'max_seconds': seconds,
+                    'queries': None, 'buckets': [0] * (len(BUCKETS) + 1),
+                }
+            stats['count'] += 1
+            stats['failed'] += failed and 1 or 0
+            stats['total_seconds'] += seconds
+            stats['min_seconds'] = min(stats['min_seconds'], seconds)
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if queries is not None:
+                stats['queries'] = (stats['queries'] or 0) + queries
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            stats['buckets'][i] += 1
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.operations.clear()
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        """
+        Returns the statistics of every operation, with the histogram as a
+        list of ``[upper bound, count]`` pairs.
+        """
+        self.lock.acquire()
+        try:
+            result = {}
+            for name, stats in self.operations.items():
+                stats = dict(stats)
+                stats['mean_seconds'] = stats['total_seconds'] / stats['count']
+                stats['buckets'] = [
+                    [bound, count] for bound, count in
+                    zip(BUCKETS + ('+Inf',), stats['buckets'])]
+                result[name] = stats
+            return result
+        finally:
+            self.lock.release()
+
+    def dumps(self, **kwargs):
+        return simplejson.dumps(self.dump(), **kwargs)
+
+
+collector = HistogramCollector()
+operation_timed.connect(collector.record)
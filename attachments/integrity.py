@@ -0,0 +1,142 @@
+"""
+Checksums of attachment files.
+
+Files are hashed with SHA-256 while they are written to the storage, through
+``HashingFile``, so the bytes aren't read a second time. The
+``verify_attachments`` command later reads them back with ``verify`` to find
+files that went missing or changed.
+"""
+import hashlib
+import threading
+import time
+
+from django.core.files.base import File
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Results of ``verify``.
+OK = 'ok'
+RECORDED = 'recorded'
+MISMATCH = 'mismatch'
+MISSING = 'missing'
+
+
+class HashingFile(File):
+    """
+    Wraps a file to compute the SHA-256 and size of what is read from it.
+
+    ``sha256`` and ``size_read`` are only set (``complete`` is True) once the
+    file has been read from the start to its end; seeking anywhere but back
+    to the start makes them unknown.
+    """
+
+    def __init__(self, file):
+        super(HashingFile, self).__init__(file, getattr(file, 'name', None))
+        self._restart()
+
+    def _restart(self):
+        self._digest = hashlib.sha256()
+        self.size_read = 0
+        self.reliable = True
+        self.complete = False
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        if self.reliable:
+            if data:
+                self._digest.update(data)
+                self.size_read += len(data)
+            elif not args or args[0] is None or args[0] > 0:
+                self.complete = True
+        return data
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+        if offset == 0 and whence == 0:
+            self._restart()
+        else:
+            self.reliable = False
+            self.complete = False
+
+    def chunks(self, chunk_size=None):
+        self.seek(0)
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    @property
+    def sha256(self):
+        if self.complete:
+            return self._digest.hexdigest()
+        return None
+
+
+class RateLimiter(object):
+    """
+    Limits the bytes read per second across all threads sharing it.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self.lock = threading.Lock()
+        self.next_read = time.time()
+
+    def consume(self, size):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self.next_read)
+            self.next_read = start + size / self.bytes_per_second
+        finally:
+            self.lock.release()
+        if start > now:
+            time.sleep(start - now)
+
+
+def hash_file(f, limiter=None):
+    """
+    Returns the SHA-256 hex digest and size of what's left in ``f``, read
+    ``READ_CHUNK_SIZE`` bytes at a time.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        if limiter is not None:
+            limiter.consume(READ_CHUNK_SIZE)
+        data = f.read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        digest.update(data)
+        size += len(data)
+    return digest.hexdigest(), size
+
+
+def verify(attachment, limiter=None):
+    """
+    Reads the file of ``attachment`` back and compares it with the recorded
+    SHA-256 and size. Returns ``(result, sha256, size)``, where ``result`` is
+    ``RECORDED`` if there was no SHA-256 to compare with yet.
+    """
+    storage, name = attachment.file.storage, attachment.file.name
+    try:
+        if not storage.exists(name):
+            return MISSING, None, None
+        f = attachment.open_file()
+    except (IOError, OSError):
+        return MISSING, None, None
+    try:
+        sha256, size = hash_file(f, limiter)
+    finally:
+        f.close()
+
+    if not attachment.sha256:
+        if attachment.size is not None and attachment.size != size:
+            return MISMATCH, sha256, size
+        return RECORDED, sha256, size
+    if attachment.sha256 != sha256 or \
+            (attachment.size is not None and attachment.size != size):
+        return MISMATCH, sha256, size
+    return OK, sha256, size
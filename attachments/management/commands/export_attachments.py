@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from attachments.archive import export_archive
+
+
+class Command(BaseCommand):
+    args = '<app_label.model>'
+    help = ("Writes the attachments of objects of a model, and their files, "
+            "to a tar archive that import_attachments can restore.")
+    option_list = BaseCommand.option_list + (
+        make_option('--pks',
+                    help="Comma separated primary keys of the objects to "
+                         "export (default: all of them)."),
+        make_option('--output', default='-',
+                    help="File to write the archive to; .tar.gz and .tar.bz2 "
+                         "are compressed (default: standard output)."),
+        make_option('--batch-size', type='int', default=200,
+                    help="Objects to load attachments for at a time."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Enter the model as app_label.model.")
+        try:
+            app_label, model_name = args[0].split('.')
+        except ValueError:
+            raise CommandError("Enter the model as app_label.model.")
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("Unknown model: %s" % args[0])
+
+        queryset = model._base_manager.all()
+        if options['pks']:
+            queryset = queryset.filter(pk__in=options['pks'].split(','))
+
+        output = options['output']
+        if output.endswith(('.tar.gz', '.tgz')):
+            mode = 'w|gz'
+        elif output.endswith(('.tar.bz2', '.tbz2')):
+            mode = 'w|bz2'
+        else:
+            mode = 'w|'
+        if output == '-':
+            count = export_archive(queryset, self.stdout, mode,
+                                   options['batch_size'])
+        else:
+            f = open(output, 'wb')
+            try:
+                count = export_archive(queryset, f, mode,
+                                       options['batch_size'])
+            finally:
+                f.close()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stderr.write("Exported %s attachments.\n" % count)
@@ -0,0 +1,59 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from attachments.archive import ArchiveError, Importer
+
+
+class Command(BaseCommand):
+    args = '<archive>'
+    help = ("Restores the attachments in an archive written by "
+            "export_attachments. Use - to read it from standard input.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+                    help="Files to store at the same time."),
+        make_option('--batch-size', type='int', default=200,
+                    help="Attachments to insert at a time."),
+        make_option('--skip-missing', action='store_true', default=False,
+                    help="Skip attachments of objects that don't exist."),
+        make_option('--user',
+                    help="Username to attach files with when their user "
+                         "doesn't exist (default: skip them)."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Enter the archive to import.")
+        default_user = None
+        if options['user']:
+            try:
+                default_user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user: %s" % options['user'])
+
+        importer = Importer(workers=options['workers'],
+                            batch_size=options['batch_size'],
+                            skip_missing=options['skip_missing'],
+                            default_user=default_user, stdout=self.stdout)
+        if args[0] == '-':
+            f = sys.stdin
+        else:
+            try:
+                f = open(args[0], 'rb')
+            except IOError, e:
+                raise CommandError("Can't open %s: %s" % (args[0], e))
+        try:
+            importer.run(f)
+        except ArchiveError, e:
+            raise CommandError(str(e))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write(
+                "Imported %s attachments, skipped %s, %s could not be "
+                "stored.\n" % (importer.imported, importer.skipped,
+                               importer.failed))
@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from attachments.processing import process_pending
+
+
+class Command(NoArgsCommand):
+    help = ("Runs the ATTACHMENT_PROCESSORS on every attachment that hasn't "
+            "been processed yet.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help="Attachments to load at a time."),
+    )
+
+    def handle_noargs(self, **options):
+        count = process_pending(batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Processed %s attachments.\n" % count)
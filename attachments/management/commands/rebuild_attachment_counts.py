@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from attachments.models import AttachmentCount
+
+
+class Command(NoArgsCommand):
+    help = ("Recalculates the attachment count and total size of every "
+            "object from the attachments table.")
+
+    def handle_noargs(self, **options):
+        AttachmentCount.objects.rebuild()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Rebuilt attachment counts for %s objects.\n"
+                              % AttachmentCount.objects.count())
@@ -0,0 +1,83 @@
+import os
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from attachments import cleanup
+from attachments.models import Attachment, ATTACHMENT_DIR
+from attachments.storage import BLOB_DIR, CONTENT_ADDRESSED
+
+
+class Command(NoArgsCommand):
+    help = ("Deletes attachments of objects that no longer exist, "
+            "derivatives of files no attachment uses, stored files "
+            "nothing refers to and abandoned chunked uploads.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Rows or file names to check at a time."),
+        make_option('--min-age', type='float', default=24,
+                    help="Only delete files older than this many hours."),
+        make_option('--upload-age', type='float', default=48,
+                    help="Delete chunked uploads nothing was appended to "
+                         "for this many hours."),
+        make_option('--path', action='append', dest='paths',
+                    help="Storage directory to look for orphaned files in "
+                         "(default: ATTACHMENT_DIR). Can be repeated."),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only report what would be deleted."),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        verbosity = int(options.get('verbosity', 1))
+        storage = Attachment._meta.get_field('file').storage
+        paths = options['paths'] or [ATTACHMENT_DIR]
+        if CONTENT_ADDRESSED and not any(
+                BLOB_DIR.startswith(os.path.join(path, '')) for path in paths):
+            paths.append(BLOB_DIR)
+
+        attachments = 0
+        for pks in cleanup.dangling_attachments(batch_size):
+            attachments += len(pks)
+            if not dry_run:
+                cleanup.delete_attachments(pks)
+
+        derivatives = 0
+        for stale in cleanup.stale_derivatives(batch_size):
+            derivatives += len(stale)
+            if not dry_run:
+                for derivative in stale:
+                    derivative.delete()
+
+        files = 0
+        min_age = timedelta(hours=options['min_age'])
+        for names in cleanup.orphaned_files(storage, paths, batch_size,
+                                            min_age):
+            files += len(names)
+            for name in names:
+                if verbosity > 1:
+                    self.stdout.write("%s\n" % name)
+                if not dry_run:
+                    storage.delete(name)
+
+        uploads = 0
+        upload_age = timedelta(hours=options['upload_age'])
+        for abandoned in cleanup.abandoned_uploads(upload_age, batch_size):
+            uploads += len(abandoned)
+            if not dry_run:
+                for upload in abandoned:
+                    upload.abort()
+        for paths in cleanup.orphaned_staging_files(upload_age, batch_size):
+            uploads += len(paths)
+            if not dry_run:
+                for path in paths:
+                    os.remove(path)
+
+        if verbosity > 0:
+            self.stdout.write(
+                "%s %s dangling attachments, %s stale derivatives, %s "
+                "orphaned files and %s abandoned uploads.\n"
+                % (dry_run and "Found" or "Deleted", attachments, derivatives,
+                   files, uploads))
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from attachments import integrity
+from attachments.models import Attachment
+from attachments.utils import map_in_threads
+
+
+class Command(NoArgsCommand):
+    help = ("Reads attachment files back to check them against their "
+            "recorded SHA-256 and size, reporting missing and changed files. "
+            "Files without a recorded SHA-256 get one.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help="Attachments to load at a time."),
+        make_option('--workers', type='int', default=4,
+                    help="Files to read at the same time."),
+        make_option('--max-rate', type='float', default=0,
+                    help="Read at most this many megabytes per second "
+                         "(default: no limit)."),
+        make_option('--older-than', type='float', default=0,
+                    help="Skip attachments verified less than this many "
+                         "days ago."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        limiter = None
+        if options['max_rate']:
+            limiter = integrity.RateLimiter(options['max_rate'] * 1024 * 1024)
+
+        attachments = Attachment.objects.exclude(file='').only(
+            'file', 'sha256', 'size')
+        if options['older_than']:
+            since = datetime.now() - timedelta(days=options['older_than'])
+            attachments = attachments.exclude(verified__gte=since)
+
+        totals = dict.fromkeys((integrity.OK, integrity.RECORDED,
+                                integrity.MISMATCH, integrity.MISSING), 0)
+        last_pk = 0
+        while True:
+            batch = list(attachments.filter(pk__gt=last_pk).order_by('pk')
+                         [:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            results = map_in_threads(
+                lambda attachment: integrity.verify(attachment, limiter),
+                batch, options['workers'])
+
+            now = datetime.now()
+            verified = []
+            for attachment, (result, sha256, size) in zip(batch, results):
+                totals[result] += 1
+                if result == integrity.OK:
+                    verified.append(attachment.pk)
+                elif result == integrity.RECORDED:
+                    Attachment.objects.filter(pk=attachment.pk).update(
+                        sha256=sha256, size=size, verified=now)
+                elif result == integrity.MISSING:
+                    self.stdout.write("MISSING %s %s\n"
+                                      % (attachment.pk, attachment.file.name))
+                else:
+                    self.stdout.write(
+                        "MISMATCH %s %s: expected %s (%s bytes), got %s "
+                        "(%s bytes)\n" % (
+                            attachment.pk, attachment.file.name,
+                            attachment.sha256, attachment.size, sha256, size))
+            if verified:
+                Attachment.objects.filter(pk__in=verified).update(
+                    verified=now)
+
+        if verbosity > 0:
+            self.stdout.write(
+                "%(ok)s verified, %(recorded)s hashed for the first time, "
+                "%(mismatch)s changed, %(missing)s missing.\n" % totals)
+        if totals[integrity.MISMATCH] or totals[integrity.MISSING]:
+            raise CommandError("%s attachment files are missing or changed."
+                               % (totals[integrity.MISMATCH] +
+                                  totals[integrity.MISSING]))
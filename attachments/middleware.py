@@ -1,25 +1,145 @@
+from attachments.utils import LRUCache
+
+# How many distinct Accept headers (and negotiation results) to remember.
+ACCEPT_CACHE_SIZE = 128
+
+_accept_cache = LRUCache(ACCEPT_CACHE_SIZE)
+_match_cache = LRUCache(ACCEPT_CACHE_SIZE)
+
+
 def parse_accept_header(accept):
-    """Parse the Accept header *accept*, returning a list with pairs of
-    (media_type, q_value), ordered by q values.
+    """Parse the Accept header *accept*, returning a list of
+    (media_type, params, q_value) tuples, ordered by q values.
+
+    Malformed media ranges and parameters are skipped rather than rejected;
+    a missing or unreadable q value counts as 1.
     """
     result = []
     for media_range in accept.split(","):
         parts = media_range.split(";")
-        media_type = parts.pop(0)
+        media_type = parts.pop(0).strip().lower()
+        if not media_type:
+            continue
         media_params = []
         q = 1.0
         for part in parts:
-            (key, value) = part.lstrip().split("=", 1)
+            key, _, value = part.partition("=")
+            key, value = key.strip().lower(), value.strip()
             if key == "q":
-                q = float(value)
-            else:
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    pass
+            elif key:
                 media_params.append((key, value))
         result.append((media_type, tuple(media_params), q))
-    result.sort(lambda x, y: -cmp(x[2], y[2]))
+    # sort() is stable, so ranges with equal q stay in the client's order.
+    result.sort(key=lambda media_range: -media_range[2])
     return result
 
+
+def _match_quality(media_type, ranges):
+    """
+    The q value of the most specific range in ``ranges`` matching
+    ``media_type``, or None if none of them does.
+    """
+    main_type = media_type.split('/', 1)[0]
+    best = None
+    for range_type, params, q in ranges:
+        if range_type == media_type:
+            specificity = 2
+        elif range_type == main_type + '/*':
+            specificity = 1
+        elif range_type in ('*/*', '*'):
+            specificity = 0
+        else:
+            continue
+        if best is None or specificity > best[0]:
+            best = (specificity, q)
+    return best and best[1]
+
+
+class Accept(object):
+    """
+    The media ranges of an Accept header, parsed the first time they are
+    needed. Parsing and negotiation results are shared between requests
+    with the same header.
+
+    Iterating gives ``(media_type, params, q)`` tuples ordered by q value.
+    """
+
+    def __init__(self, header):
+        self.header = header or ''
+
+    @property
+    def ranges(self):
+        header = self.header
+        return _accept_cache.get(header,
+                                 lambda: tuple(parse_accept_header(header)))
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __getitem__(self, index):
+        return self.ranges[index]
+
+    def best_match(self, available_types, default=None):
+        """
+        Returns the type from ``available_types`` the client prefers, or
+        ``default`` if it accepts none of them. Ties go to the type listed
+        first, as does a missing Accept header.
+        """
+        available_types = tuple(available_types)
+        return _match_cache.get(
+            (self.header, available_types),
+            lambda: self._best_match(available_types)) or default
+
+    def _best_match(self, available_types):
+        ranges = self.ranges
+        if not ranges:
+            return available_types and available_types[0] or None
+        best_type, best_q = None, 0
+        for media_type in available_types:
+            q = _match_quality(media_type.lower(), ranges)
+            if q is not None and q > best_q:
+                best_type, best_q = media_type, q
+        return best_type
+
+
+class AcceptedTypes(object):
+    """
+    The media types of an ``Accept``, most preferred first.
+    """
+
+    def __init__(self, accept):
+        self.accept = accept
+
+    def __iter__(self):
+        return (media_type for media_type, params, q in self.accept)
+
+    def __len__(self):
+        return len(self.accept)
+
+    def __getitem__(self, index):
+        return self.accept[index][0]
+
+
+def get_accept(request):
+    """
+    Returns the ``Accept`` of ``request``, also when AcceptMiddleware isn't
+    installed.
+    """
+    accept = getattr(request, 'accept', None)
+    if accept is None:
+        accept = request.accept = Accept(request.META.get("HTTP_ACCEPT", ""))
+    return accept
+
+
 class AcceptMiddleware(object):
     def process_request(self, request):
-        accept = parse_accept_header(request.META.get("HTTP_ACCEPT", ""))
-        request.accept = accept
-        request.accepted_types = map(lambda (t, p, q): t, accept)
+        # Nothing is parsed until a view looks at these.
+        request.accept = Accept(request.META.get("HTTP_ACCEPT", ""))
+        request.accepted_types = AcceptedTypes(request.accept)
@@ -1,9 +1,13 @@
 from __future__ import with_statement
 
-import tempfile, urllib2, shutil
+import tempfile, hashlib, base64, uuid, mimetypes
 
-from django.db import models, connection
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count, Sum, signals
+from django.db.models.fields.files import FieldFile
+from django.core.signals import request_finished, got_request_exception
 from django.core.files import File
+from django.core.files.storage import default_storage
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User
@@ -11,15 +15,20 @@ from django.conf import settings
 from django.utils import encoding
 from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
-from django.core.exceptions import ImproperlyConfigured
 
-qn = connection.ops.quote_name
-
-import os.path
+import os
+from contextlib import contextmanager
 from datetime import datetime
 
+import cache
 import directory_schemes
-from utils import get_callable_from_string, unique_slugify
+import integrity
+import remote
+from instrumentation import instrumented, timed
+from storage import CONTENT_ADDRESSED, ContentAddressedStorage
+from utils import unique_slugify, unique_slugs, map_in_threads, \
+    commit_on_success_unless_managed, run_after_commit, flush_after_commit, \
+    discard_after_commit, cached_reverse
 
 # Get relative media path
 try:
@@ -27,6 +36,65 @@ try:
 except:
     ATTACHMENT_DIR = "attachments"
 
+# Storage for attachment files; None means the default storage.
+if CONTENT_ADDRESSED:
+    attachment_storage = ContentAddressedStorage()
+else:
+    attachment_storage = None
+
+# Storage for thumbnails and other derivatives of attachment files.
+derivative_storage = default_storage
+
+# How many files copy_attachments copies at the same time for deep copies.
+COPY_THREADS = getattr(settings, 'ATTACHMENT_COPY_THREADS', 4)
+
+# Where partially uploaded files of chunked uploads are kept.
+UPLOAD_STAGING_DIR = getattr(settings, 'ATTACHMENT_UPLOAD_STAGING_DIR',
+                             os.path.join(tempfile.gettempdir(),
+                                          'attachment-uploads'))
+
+# Attribute on content objects holding the list filled in by
+# ``AttachmentManager.prefetch_attachments``.
+PREFETCH_CACHE_ATTR = '_prefetched_attachments'
+
+# How many times ``Attachment.save`` picks a new slug when a concurrent save
+# took the one it calculated.
+SLUG_SAVE_ATTEMPTS = 5
+
+# Fields filled in by processing that can be large; the listing queries
+# leave them out, which also keeps cached lists small.
+DEFERRED_FIELDS = ('extracted_text', 'processing_log')
+
+# Maximum number of object ids in a single ``IN`` clause when prefetching.
+PREFETCH_BATCH_SIZE = 500
+
+class AttachmentFieldFile(FieldFile):
+    def save(self, name, content, save=True):
+        """
+        Stores the file and records its SHA-256 and size on the attachment,
+        computed from the bytes as the storage reads them.
+        """
+        if hasattr(content, 'temporary_file_path'):
+            # The storage may just move the file without reading it, so hash
+            # it here first; that costs one extra read of the file.
+            with open(content.temporary_file_path(), 'rb') as f:
+                sha256, size = integrity.hash_file(f)
+            content.seek(0)
+        else:
+            content = integrity.HashingFile(content)
+        # Time the storage write on its own, without saving the model.
+        with timed('storage.save'):
+            super(AttachmentFieldFile, self).save(name, content, save=False)
+        if isinstance(content, integrity.HashingFile):
+            sha256, size = content.sha256, content.size_read
+        if sha256:
+            self.instance.sha256, self.instance.size = sha256, size
+        if save:
+            self.instance.save()
+
+class AttachmentFileField(models.FileField):
+    attr_class = AttachmentFieldFile
+
 class AttachmentManager(models.Manager):
     """
     Methods borrowed from django-threadedcomments
@@ -43,17 +111,21 @@ class AttachmentManager(models.Manager):
             kwargs['object_id'] = content_object.id
         return kwargs
 
+    @instrumented('manager.create_for_object')
     def create_for_object(self, content_object, **kwargs):
         """
         A simple wrapper around ``create`` for a given ``content_object``.
         """
         return self.create(**self._generate_object_kwarg_dict(content_object, **kwargs))
 
+    @instrumented('manager.attachments_for_object')
     def attachments_for_object(self, content_object, file_name=None, title=None, **kwargs):
         """
         Prepopulates a QuerySet with all attachments related to the given ``content_object``.
+        ``DEFERRED_FIELDS`` are only loaded when accessed.
         """
         query = self.filter(**self._generate_object_kwarg_dict(content_object, **kwargs))
+        query = query.defer(*DEFERRED_FIELDS)
         if file_name:
             query = query.filter(file__iendswith=file_name)
         if title:
@@ -61,99 +133,234 @@ class AttachmentManager(models.Manager):
 
         return query
 
-    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None):
+    @instrumented('manager.attachments_for_objects')
+    def attachments_for_objects(self, objects):
         """
-        Perform the custom SQL query for ``usage_for_model`` and
-        ``usage_for_queryset``.
+        Fetches the attachments for all of the given ``objects`` at once.
+
+        Objects are grouped by ``ContentType`` and a single ``IN`` query is
+        issued per content type (per ``PREFETCH_BATCH_SIZE`` objects). Returns
+        a dictionary mapping ``(content_type_id, object_id)`` to the list of
+        attachments for that object, in the default ordering.
         """
-        if min_count is not None: counts = True
+        ids_by_type = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            ids_by_type.setdefault(content_type.pk, set()).add(obj.pk)
+
+        result = {}
+        for content_type_id, ids in ids_by_type.items():
+            ids = list(ids)
+            for i in range(0, len(ids), PREFETCH_BATCH_SIZE):
+                query = self.filter(
+                    content_type=content_type_id,
+                    object_id__in=ids[i:i + PREFETCH_BATCH_SIZE],
+                ).select_related('attached_by').defer(*DEFERRED_FIELDS)
+                for attachment in query:
+                    key = (content_type_id, attachment.object_id)
+                    result.setdefault(key, []).append(attachment)
+        return result
+
+    @instrumented('manager.prefetch_attachments')
+    def prefetch_attachments(self, objects):
+        """
+        Stores the attachments of every object in ``objects`` on the object
+        itself so that ``attachment_list_for_object`` (and therefore the
+        ``get_attachments`` template tag) won't query for them again.
 
-        model_table = qn(model._meta.db_table)
-        model_pk = '%s.%s' % (model_table, qn(model._meta.pk.column))
-
-        # Grab all of the attachment fields
-        field_cols = [field.attname for field in self.model._meta.local_fields]
-        quoted_field_cols = [qn(col) for col in field_cols]
-        attachment = qn(self.model._meta.db_table)
-        table_field_cols = ['%s.%s' % (attachment, col) for col in quoted_field_cols]
-        query = """
-        SELECT DISTINCT %(fields)s%(count_sql)s
-        FROM
-            %(attachment)s
-            INNER JOIN %(model)s
-                ON %(attachment)s.object_id = %(model_pk)s
-            %%s
-        WHERE %(attachment)s.content_type_id = %(content_type_id)s
-            %%s
-        GROUP BY %(attachment)s.id
-        %%s
-        ORDER BY %(attachment)s.id ASC""" % {
-            'fields': ', '.join(table_field_cols),
-            'attachment': attachment,
-            'count_sql': counts and (', COUNT(%s)' % model_pk) or '',
-            'model': model_table,
-            'model_pk': model_pk,
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-        }
-
-        min_count_sql = ''
-        if min_count is not None:
-            min_count_sql = 'HAVING COUNT(%s) >= %%s' % model_pk
-            params.append(min_count)
-
-        cursor = connection.cursor()
-        cursor.execute(query % (extra_joins, extra_criteria, min_count_sql), params)
-        attachments = []
-        for row in cursor.fetchall():
-            if counts:
-                field_row = row[:-1]
-            else:
-                field_row = row
-            result_tuple = zip(field_cols, field_row)
-            result_dict = {}
-            for col, val in result_tuple:
-                result_dict[col] = val
-            a = self.model(**result_dict)
-            if counts:
-                a.count = row[-1:]
-            attachments.append(a)
+        Returns the objects as a list.
+        """
+        objects = list(objects)
+        attachments = self.attachments_for_objects(objects)
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            setattr(obj, PREFETCH_CACHE_ATTR,
+                    attachments.get((content_type.pk, obj.pk), []))
+        return objects
+
+    @instrumented('manager.attachment_list_for_object')
+    def attachment_list_for_object(self, content_object):
+        """
+        Returns the list of attachments for ``content_object``, reusing the
+        list stored by ``prefetch_attachments`` when there is one, or the
+        cached one (see ``attachments.cache``).
+
+        Other lists aren't kept on the object, so attachments added since
+        are always included.
+        """
+        attachments = getattr(content_object, PREFETCH_CACHE_ATTR, None)
+        if attachments is None:
+            attachments = cache.get_attachment_list(
+                ContentType.objects.get_for_model(content_object).pk,
+                content_object.pk,
+                lambda: self.attachments_for_object(
+                    content_object).select_related('attached_by'))
         return attachments
 
+    @instrumented('manager.usage_for_queryset')
     def usage_for_queryset(self, queryset, counts=False, min_count=None):
         """
-        Obtain a list of tags associated with instances of a model
+        Obtain the attachments associated with instances of a model
         contained in the given queryset.
 
         If ``counts`` is True, a ``count`` attribute will be added to
-        each tag, indicating how many times it has been used against
-        the Model class in question.
+        each attachment, indicating how many of the instances it is
+        attached to.
 
-        If ``min_count`` is given, only tags which have a ``count``
+        If ``min_count`` is given, only attachments which have a ``count``
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
+
+        The result is a QuerySet with the instances selected by a subquery,
+        so ``.iterator()`` can be used to go through large results without
+        loading them all into memory.
         """
+        if min_count is not None: counts = True
 
-        extra_joins = ' '.join(queryset.query.get_from_clause()[0][1:])
-        where, params = queryset.query.where.as_sql()
-        if where:
-            extra_criteria = 'AND %s' % where
-        else:
-            extra_criteria = ''
-        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params)
+        attachments = self.filter(
+            content_type=ContentType.objects.get_for_model(queryset.model),
+            object_id__in=queryset.values('pk')).order_by('id')
+        if counts:
+            attachments = attachments.annotate(count=Count('id'))
+            if min_count is not None:
+                attachments = attachments.filter(count__gte=min_count)
+        return attachments
+
+    @instrumented('manager.usage_for_model')
+    def usage_for_model(self, model, counts=False, min_count=None,
+                        filters=None):
+        """
+        Obtain the attachments associated with instances of the given
+        ``model``, optionally narrowed down by the field lookups in the
+        ``filters`` dictionary. See ``usage_for_queryset``.
+        """
+        queryset = model._default_manager.filter(**(filters or {}))
+        return self.usage_for_queryset(queryset, counts, min_count)
 
+    @instrumented('manager.copy_attachments')
     def copy_attachments(self, from_object, to_object, deepcopy=False):
         """
         Copy all of the attachments on from_object to to_object. The
-        fields will be pointing at the same file unless deepcopy is False.
+        fields will be pointing at the same file unless deepcopy is True.
+
+        Files of deep copies are copied ``ATTACHMENT_COPY_THREADS`` at a time
+        before the target's old attachments are replaced with the copies in a
+        single transaction. Slugs are kept as they are, since they were
+        already unique on from_object.
+        """
+        copies = []
+        deep_copies = []
+        # The copies need every field.
+        originals = self.attachments_for_object(from_object).defer(None)
+        for attachment in originals:
+            copy = attachment._copy_for(to_object)
+            if deepcopy and attachment.file and not CONTENT_ADDRESSED:
+                deep_copies.append((attachment, copy))
+            elif attachment.file:
+                copy.file = attachment.file.name
+            copies.append(copy)
+
+        # Shallow copies share their files with the originals; only the new
+        # files of deep copies are removed again if anything fails.
+        with self._deleting_files_on_error([c for a, c in deep_copies]):
+            map_in_threads(
+                lambda (attachment, copy): attachment._copy_file_to(copy),
+                deep_copies, COPY_THREADS)
+
+            with commit_on_success_unless_managed():
+                # First delete all of the attachments on the to_object
+                old_attachments = self.attachments_for_object(to_object)
+                old_attachments.delete()
+                self._bulk_create(copies)
+
+    @contextmanager
+    def _deleting_files_on_error(self, attachments):
+        """
+        Deletes the already stored files of the new ``attachments`` if the
+        block fails, eg. because they couldn't be inserted.
+        """
+        try:
+            yield
+        except:
+            # Content-addressed files may be shared with other attachments.
+            if not CONTENT_ADDRESSED:
+                for attachment in attachments:
+                    if attachment.file:
+                        attachment.file.delete(save=False)
+            raise
+
+    @instrumented('manager.bulk_create_for_object')
+    def bulk_create_for_object(self, content_object, attachments):
         """
-        # First delete all of the attachments on the to_object
-        old_attachments = self.attachments_for_object(to_object)
-        old_attachments.delete()
+        Saves the new ``attachments``, whose files are already stored, as
+        attachments of ``content_object`` in a single transaction.
 
-        attachments = self.attachments_for_object(from_object)
+        Their slugs are allocated together (from their titles, which default
+        to the file names) with as few queries as possible. Like
+        ``bulk_create``, this doesn't call ``save`` or send signals. Returns
+        the attachments, with their primary keys filled in.
+        """
+        if not attachments:
+            return attachments
+        kwargs = self._generate_object_kwarg_dict(content_object)
+        for attachment in attachments:
+            attachment.content_type = kwargs['content_type']
+            attachment.object_id = kwargs['object_id']
+            if not attachment.title:
+                attachment.title = attachment.file_name()
+            if attachment.size is None and attachment.file:
+                attachment.size = attachment.file.size
+
+        with commit_on_success_unless_managed():
+            # As in Attachment.save, a concurrent save taking one of the
+            # slugs makes us start over with fresh ones.
+            for attempt in range(SLUG_SAVE_ATTEMPTS):
+                slugs = unique_slugs(
+                    Attachment, [a.title for a in attachments],
+                    queryset=self.filter(**kwargs))
+                for attachment, slug in zip(attachments, slugs):
+                    attachment.slug = slug
+
+                sid = transaction.savepoint()
+                try:
+                    self._bulk_create(attachments)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    if attempt == SLUG_SAVE_ATTEMPTS - 1:
+                        raise
+                else:
+                    transaction.savepoint_commit(sid)
+                    break
+
+            pks = dict(self.filter(slug__in=slugs, **kwargs).values_list(
+                'slug', 'pk'))
+        for attachment in attachments:
+            attachment.pk = pks[attachment.slug]
+        return attachments
 
+    def _bulk_create(self, attachments):
+        """
+        Inserts ``attachments`` with a single query. ``bulk_create`` doesn't
+        call ``save`` or send signals, so the bookkeeping those would do is
+        done here instead.
+        """
+        self.bulk_create(attachments)
+        totals = {}
         for attachment in attachments:
-            copy = attachment.copy(to_object, deepcopy)
+            key = (attachment.content_type_id, attachment.object_id)
+            count, size = totals.get(key, (0, 0))
+            totals[key] = (count + 1, size + (attachment.size or 0))
+        for key, (count, size) in totals.items():
+            AttachmentCount.objects.adjust(key[0], key[1], count, size)
+            cache.invalidate(*key)
+        if CONTENT_ADDRESSED:
+            names = {}
+            for attachment in attachments:
+                if attachment.file:
+                    names[attachment.file.name] = names.get(
+                        attachment.file.name, 0) + 1
+            for name, count in names.items():
+                Blob.objects.incref(name, count)
 
 
 class Attachment(models.Model):
@@ -165,20 +372,12 @@ class Attachment(models.Model):
         is a callable (in the same string format as TEMPLATE_LOADERS) that takes
         an attachment and a filename and then returns a string.
         """
-        if getattr(settings, 'ATTACHMENT_STORAGE_DIR', None):
-            try:
-                dir_builder = get_callable_from_string(
-                    settings.ATTACHMENT_STORAGE_DIR)
-            except ImproperlyConfigured:
-                # Callable didn't load correctly
-                dir_builder = directory_schemes.by_app
-        else:
-            dir_builder = directory_schemes.by_app
-
-        return dir_builder(instance, filename)
+        with timed('attachment.upload_to'):
+            return directory_schemes.get_directory_scheme()(instance,
+                                                            filename)
 
-    file = models.FileField(_("file"), upload_to=get_attachment_dir,
-                            max_length=255)
+    file = AttachmentFileField(_("file"), upload_to=get_attachment_dir,
+                               storage=attachment_storage, max_length=255)
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey("content_type", "object_id")
@@ -187,6 +386,20 @@ class Attachment(models.Model):
     title = models.CharField(_("title"), max_length=200, blank=True, null=True)
     slug = models.SlugField(_("slug"), editable=False)
     summary = models.TextField(_("summary"), blank=True, null=True)
+    size = models.BigIntegerField(_("size"), blank=True, null=True,
+                                  editable=False)
+    sha256 = models.CharField(_("SHA-256"), max_length=64, blank=True,
+                              null=True, editable=False)
+    mime_type = models.CharField(_("MIME type"), max_length=100, blank=True,
+                                 null=True, editable=False)
+    extracted_text = models.TextField(_("extracted text"), blank=True,
+                                      null=True, editable=False)
+    processed = models.DateTimeField(_("processed"), blank=True, null=True,
+                                     editable=False)
+    processing_log = models.TextField(_("processing log"), blank=True,
+                                      null=True, editable=False)
+    verified = models.DateTimeField(_("verified"), blank=True, null=True,
+                                    editable=False)
     attached_by = models.ForeignKey(
         User, verbose_name=_("attached by"),
         related_name="attachment_attached_by", editable=False)
@@ -198,20 +411,54 @@ class Attachment(models.Model):
         get_latest_by = 'attached_timestamp'
         verbose_name = _('attachment')
         verbose_name_plural = _('attachments')
+        unique_together = (('content_type', 'object_id', 'slug'),)
 
     def __unicode__(self):
         return self.title or self.file_name()
 
+    @instrumented('attachment.save')
     def save(self, force_insert=False, force_update=False, **kwargs):
-        # Ensure this slug is unique amongst attachments attached to this object
-        queryset = Attachment.objects.filter(
-            content_type=self.content_type, object_id=self.object_id)
-        if self.pk:
-            queryset = queryset.exclude(pk=self.pk)
-        unique_slugify(self, self.title, queryset=queryset)
-        if not self.title:
-            self.title = self.file_name()
-        super(Attachment, self).save(force_insert, force_update)
+        if self.file and not self.file._committed:
+            # A new file; whatever was found out about the old one is stale.
+            self.sha256 = self.mime_type = self.extracted_text = None
+            self.processed = self.processing_log = self.verified = None
+        if self.file and (self.size is None or not self.file._committed):
+            try:
+                self.size = self.file.size
+            except (OSError, IOError, NotImplementedError):
+                pass
+
+        # Ensure this slug is unique amongst attachments attached to this
+        # object. The unique constraint catches a concurrent save grabbing the
+        # same slug in between, in which case we pick another one and retry.
+        # The post_save bookkeeping (counts, blob references) happens in the
+        # same transaction.
+        title = self.title
+        with commit_on_success_unless_managed():
+            for attempt in range(SLUG_SAVE_ATTEMPTS):
+                queryset = Attachment.objects.filter(
+                    content_type=self.content_type, object_id=self.object_id)
+                if self.pk:
+                    queryset = queryset.exclude(pk=self.pk)
+                with timed('attachment.slugify'):
+                    unique_slugify(self, title, queryset=queryset)
+                if not self.title:
+                    self.title = self.file_name()
+
+                sid = transaction.savepoint()
+                try:
+                    super(Attachment, self).save(force_insert, force_update)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    if attempt == SLUG_SAVE_ATTEMPTS - 1:
+                        raise
+                else:
+                    transaction.savepoint_commit(sid)
+                    break
+
+    def delete(self, *args, **kwargs):
+        with commit_on_success_unless_managed():
+            super(Attachment, self).delete(*args, **kwargs)
 
     def file_url(self):
         return self.file.url
@@ -222,55 +469,489 @@ class Attachment(models.Model):
         """
         return os.path.basename(self.file.name)
 
+    def is_image(self):
+        """
+        Whether the file looks like an image, judging by its name.
+        """
+        mime_type, encoding = mimetypes.guess_type(self.file.name)
+        return bool(mime_type and mime_type.startswith('image/'))
+
+    def derivative_url(self, name):
+        """
+        The URL of the derivative ``name`` of the file. It changes along
+        with the file, so responses can be cached for long.
+        """
+        url = cached_reverse('attachment_derivative', attachment_id=self.pk,
+                             name=name)
+        return '%s?v=%s' % (url, hashlib.md5(
+            encoding.smart_str(self.file.name)).hexdigest()[:8])
+
+    def thumbnail_url(self):
+        return self.derivative_url('thumbnail')
+
+    def delete_url(self):
+        return cached_reverse('attachment_delete', attachment_id=self.pk)
+
+    def open_file(self):
+        """
+        Opens the file for reading. Storages that can't open their files
+        (eg. remote ones) have it downloaded into a temporary file instead.
+        """
+        try:
+            return self.file.storage.open(self.file.name, 'rb')
+        except NotImplementedError:
+            source = tempfile.TemporaryFile()
+            remote.fetch(self.file.url, source)
+            source.seek(0)
+            return source
+
+    @instrumented('attachment.copy')
     def copy(self, to_object, deepcopy=False):
         """
         Create a copy of this attachment that's attached to to_object instead of
         the current content_object. If deepcopy is set to true, the file will be
         copied instead of both attachments pointing at the same file.
+        """
+        copy = self._copy_for(to_object)
 
-        Convoluted copying is needed in order for the upload_to function in the
-        FileField to actually be evaluated properly.
+        if deepcopy and self.file and not CONTENT_ADDRESSED:
+            # Content-addressed files are stored once, so there's nothing to
+            # copy; the new attachment just references the same blob.
+            self._copy_file_to(copy)
+        elif self.file:
+            copy.file = self.file.name
+
+        copy.save()
+        return copy
+
+    def _copy_for(self, to_object):
+        """
+        Returns an unsaved copy of this attachment, without the file, that's
+        attached to to_object.
         """
         copy = Attachment()
 
         copy.title = self.title
         copy.slug = self.slug
         copy.summary = self.summary
-        copy.attached_by = self.attached_by
+        copy.size = self.size
+        copy.sha256 = self.sha256
+        copy.mime_type = self.mime_type
+        copy.extracted_text = self.extracted_text
+        copy.processed = self.processed
+        copy.processing_log = self.processing_log
+        copy.attached_by_id = self.attached_by_id
+
+        # Modify the generic FK so that it points to the 'to_object'. Setting
+        # content_object also caches it for the directory scheme.
+        copy.content_object = to_object
+        return copy
+
+    def _copy_file_to(self, copy):
+        """
+        Stores a copy of this attachment's file for ``copy`` without saving
+        ``copy`` itself.
+
+        Storages with a ``copy(name, new_name)`` method copy the file
+        themselves (eg. server side). Otherwise the file is streamed from the
+        storage's ``open``, or, if the storage can't open files, downloaded
+        from its URL into a temporary file first.
+        """
+        field = copy.file.field
+        storage = self.file.storage
 
-        # Modify the generic FK so that it points to the 'to_object'
-        kwargs_dict = Attachment.objects._generate_object_kwarg_dict(to_object)
-        for field, value in kwargs_dict.items():
-            setattr(copy, field, value)
+        if hasattr(storage, 'copy'):
+            name = field.generate_filename(copy, self.file_name())
+            copy.file.name = storage.copy(self.file.name,
+                                          storage.get_available_name(name))
+            return
 
+        source = self.open_file()
         try:
-            path = self.file.path
-        except NotImplementedError:
-            # Not a local file, download it to copy it.
-            # The file system backend doesn't support absolute paths. DL the file.
-            tmp_dir = tempfile.mkdtemp()
-            _, name = os.path.split(self.file.name)
-            path = os.path.join(tmp_dir, name)
-            with open(path, 'w') as local_f:
-                try:
-                    remote_f = urllib2.urlopen(self.file.url)
-                except IOError:
-                    # Possible S3 propogation delay problem. Give it another try
-                    remote_f = urllib2.urlopen(self.file.url)
-                shutil.copyfileobj(remote_f, local_f)
+            copy.file.save(self.file_name(), File(source), save=False)
+        finally:
+            source.close()
+
+class Attachable(models.Model):
+    """
+    Abstract base for models that get attachments. Gives them an
+    ``attachments`` relation, through which deleting an object deletes its
+    attachments (and, once committed, their files) too.
+    """
+    attachments = generic.GenericRelation(Attachment)
+
+    class Meta:
+        abstract = True
+
+    def delete(self, *args, **kwargs):
+        with commit_on_success_unless_managed():
+            super(Attachable, self).delete(*args, **kwargs)
+
+class BlobManager(models.Manager):
+    def incref(self, name, count=1):
+        """
+        Records ``count`` more attachments pointing at the stored file
+        ``name``.
+        """
+        if self.filter(name=name).update(refcount=F('refcount') + count):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(name=name, refcount=count)
+        except IntegrityError:
+            # Somebody else created it in the meantime.
+            transaction.savepoint_rollback(sid)
+            self.filter(name=name).update(refcount=F('refcount') + count)
         else:
-            local_f = self.file
+            transaction.savepoint_commit(sid)
 
-        if deepcopy and self.file:
-            with open(path) as local_f:
-                copy.file.save(self.file_name(), File(local_f))
-        elif self.file:
-            copy.file = self.file
+    def decref(self, name, count=1):
+        """
+        Records ``count`` fewer attachments pointing at the stored file
+        ``name``, deleting the file once nothing references it any more.
+        """
+        self.filter(name=name).update(refcount=F('refcount') - count)
+        for blob in self.filter(name=name, refcount__lte=0):
+            blob.delete()
+            _delete_file_after_commit(blob.name)
 
-        copy.save()
-        return copy
+class Blob(models.Model):
+    """
+    Reference count of a file stored by ``ContentAddressedStorage``.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.IntegerField(default=0)
+
+    objects = BlobManager()
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.name, self.refcount)
+
+class AttachmentCountManager(models.Manager):
+    def adjust(self, content_type_id, object_id, count, size):
+        """
+        Adds ``count`` attachments and ``size`` bytes (either may be negative)
+        to the totals of the given object.
+        """
+        totals = self.filter(content_type=content_type_id, object_id=object_id)
+        if totals.update(count=F('count') + count,
+                         total_size=F('total_size') + size):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(content_type_id=content_type_id, object_id=object_id,
+                        count=count, total_size=size)
+        except IntegrityError:
+            # Somebody else created it in the meantime.
+            transaction.savepoint_rollback(sid)
+            totals.update(count=F('count') + count,
+                          total_size=F('total_size') + size)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def for_objects(self, objects):
+        """
+        Returns a dictionary mapping ``(content_type_id, object_id)`` of each
+        of the given ``objects`` to its ``AttachmentCount``, with one query
+        per content type. Objects without attachments get an unsaved one with
+        zero totals.
+        """
+        ids_by_type = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            ids_by_type.setdefault(content_type.pk, set()).add(obj.pk)
+
+        result = {}
+        for content_type_id, ids in ids_by_type.items():
+            for obj_id in ids:
+                result[(content_type_id, obj_id)] = AttachmentCount(
+                    content_type_id=content_type_id, object_id=obj_id)
+            ids = list(ids)
+            for i in range(0, len(ids), PREFETCH_BATCH_SIZE):
+                for totals in self.filter(
+                        content_type=content_type_id,
+                        object_id__in=ids[i:i + PREFETCH_BATCH_SIZE]):
+                    result[(content_type_id, totals.object_id)] = totals
+        return result
+
+    def for_object(self, content_object):
+        return self.for_objects([content_object]).values()[0]
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recalculates all totals from the attachments table.
+        """
+        with commit_on_success_unless_managed():
+            self.all().delete()
+            totals = Attachment.objects.values(
+                'content_type', 'object_id').annotate(
+                count=Count('id'), total_size=Sum('size')).order_by()
+            batch = []
+            for row in totals.iterator():
+                batch.append(AttachmentCount(
+                    content_type_id=row['content_type'],
+                    object_id=row['object_id'], count=row['count'],
+                    total_size=row['total_size'] or 0))
+                if len(batch) == batch_size:
+                    self.bulk_create(batch)
+                    batch = []
+            self.bulk_create(batch)
+
+class AttachmentCount(models.Model):
+    """
+    The number of attachments of an object and their total size, kept up to
+    date as attachments are saved, copied and deleted.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey("content_type", "object_id")
+    count = models.IntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+
+    objects = AttachmentCountManager()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    def __unicode__(self):
+        return u'%s attachments, %s bytes' % (self.count, self.total_size)
+
+class Derivative(models.Model):
+    """
+    A thumbnail or preview made from a stored attachment file.
+
+    Derivatives belong to the stored file (``source``) rather than to an
+    attachment, so that attachments sharing a file share its derivatives.
+    ``last_accessed`` orders them for eviction; see ``attachments.derivatives``.
+    """
+    source = models.CharField(max_length=255)
+    name = models.CharField(max_length=50)
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    created = models.DateTimeField(default=datetime.now)
+    last_accessed = models.DateTimeField(default=datetime.now, db_index=True)
+
+    class Meta:
+        unique_together = (('source', 'name'),)
+
+    def __unicode__(self):
+        return self.file_name
 
-class TestModel(models.Model):
+    def delete(self, *args, **kwargs):
+        super(Derivative, self).delete(*args, **kwargs)
+        # Keep the file until the row is gone for good.
+        file_name = self.file_name
+        run_after_commit(lambda: derivative_storage.delete(file_name))
+
+def _delete_unreferenced_file(name):
+    """
+    Deletes the stored file ``name`` and its derivatives, unless an
+    attachment (or, with content-addressed storage, a blob) still refers to
+    it.
+    """
+    if Attachment.objects.filter(file=name).exists():
+        return
+    if CONTENT_ADDRESSED and Blob.objects.filter(name=name).exists():
+        return
+    for derivative in Derivative.objects.filter(source=name):
+        derivative.delete()
+    Attachment._meta.get_field('file').storage.delete(name)
+
+def _delete_file_after_commit(name):
+    # Deleting right away would lose the file if the transaction rolled
+    # back. Checking for references only afterwards also keeps files that
+    # another attachment (eg. a shallow copy) took over in the meantime.
+    run_after_commit(lambda: _delete_unreferenced_file(name))
+
+def _remember_previous(sender, instance, **kwargs):
+    previous = None
+    if instance.pk:
+        rows = Attachment.objects.filter(
+            pk=instance.pk).values_list('file', 'size')
+        previous = (list(rows) or [None])[0]
+    instance._previous = previous
+
+def _count_attachment(sender, instance, created, **kwargs):
+    if getattr(instance, '_previous', None) is None:
+        AttachmentCount.objects.adjust(instance.content_type_id,
+                                       instance.object_id, 1,
+                                       instance.size or 0)
+    elif instance.size != instance._previous[1]:
+        AttachmentCount.objects.adjust(
+            instance.content_type_id, instance.object_id, 0,
+            (instance.size or 0) - (instance._previous[1] or 0))
+
+def _uncount_attachment(sender, instance, **kwargs):
+    AttachmentCount.objects.adjust(instance.content_type_id,
+                                   instance.object_id, -1,
+                                   -(instance.size or 0))
+
+def _count_blob_reference(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    previous = previous and previous[0] or ''
+    if instance.file.name != previous:
+        if instance.file:
+            Blob.objects.incref(instance.file.name)
+        if previous:
+            Blob.objects.decref(previous)
+
+def _release_blob_reference(sender, instance, **kwargs):
+    if instance.file:
+        Blob.objects.decref(instance.file.name)
+
+def _delete_replaced_file(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    if previous and previous[0] and previous[0] != instance.file.name:
+        _delete_file_after_commit(previous[0])
+
+def _delete_file(sender, instance, **kwargs):
+    if instance.file:
+        _delete_file_after_commit(instance.file.name)
+
+_attachment_handlers = [
+    (signals.pre_save, _remember_previous),
+    (signals.post_save, _count_attachment),
+    (signals.post_delete, _uncount_attachment),
+]
+if CONTENT_ADDRESSED:
+    _attachment_handlers += [
+        (signals.post_save, _count_blob_reference),
+        (signals.post_delete, _release_blob_reference),
+    ]
+else:
+    _attachment_handlers += [
+        (signals.post_save, _delete_replaced_file),
+        (signals.post_delete, _delete_file),
+    ]
+_attachment_handlers += [
+    (signals.post_save, cache.invalidate_attachment),
+    (signals.post_delete, cache.invalidate_attachment),
+]
+
+def _connect_attachment_handlers(sender, **kwargs):
+    # Attachments loaded with deferred fields (see ``DEFERRED_FIELDS``) are
+    # instances of a subclass made on the fly, which Django sends the save
+    # and delete signals for.
+    if issubclass(sender, Attachment):
+        for signal, handler in _attachment_handlers:
+            signal.connect(handler, sender=sender)
+
+_connect_attachment_handlers(Attachment)
+signals.class_prepared.connect(_connect_attachment_handlers)
+
+request_finished.connect(flush_after_commit)
+got_request_exception.connect(discard_after_commit)
+
+# Resolve the directory scheme now so that a misconfigured
+# ATTACHMENT_STORAGE_DIR fails when the app is loaded, not on the first upload.
+directory_schemes.get_directory_scheme()
+
+class ChunkedUploadError(Exception):
+    pass
+
+class ChunkedUpload(models.Model):
+    """
+    A file being uploaded in several requests.
+
+    Chunks are appended to a staging file in ``UPLOAD_STAGING_DIR`` and the
+    upload can be resumed from ``offset`` after a dropped connection. Once
+    all ``size`` bytes have arrived, the staging file becomes an
+    ``Attachment`` of ``content_object``.
+    """
+    upload_id = models.CharField(max_length=32, unique=True, editable=False)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey("content_type", "object_id")
+    user = models.ForeignKey(User, related_name="attachment_uploads")
+    filename = models.CharField(max_length=255)
+    title = models.CharField(max_length=200, blank=True, null=True)
+    summary = models.TextField(blank=True, null=True)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    started = models.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return u'%s (%s/%s)' % (self.filename, self.offset, self.size)
+
+    def save(self, *args, **kwargs):
+        if not self.upload_id:
+            self.upload_id = uuid.uuid4().hex
+        super(ChunkedUpload, self).save(*args, **kwargs)
+
+    @property
+    def staging_path(self):
+        return os.path.join(UPLOAD_STAGING_DIR, self.upload_id)
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def append(self, stream, start, length, md5=None, chunk_size=64 * 1024):
+        """
+        Copies ``length`` bytes from the file-like ``stream`` to the end of the
+        staging file, ``chunk_size`` bytes at a time.
+
+        ``start`` must match the current ``offset``. If given, ``md5`` is the
+        base64 encoded MD5 digest of the chunk (as in a ``Content-MD5``
+        header); a chunk that doesn't match it is discarded.
+        """
+        if start != self.offset:
+            raise ChunkedUploadError("Expected a chunk starting at %s, got %s"
+                                     % (self.offset, start))
+        if self.offset + length > self.size:
+            raise ChunkedUploadError("Chunk goes past the end of the file")
+
+        if not os.path.isdir(UPLOAD_STAGING_DIR):
+            os.makedirs(UPLOAD_STAGING_DIR)
+        digest = hashlib.md5()
+        if os.path.exists(self.staging_path):
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        with open(self.staging_path, mode) as staging:
+            staging.seek(self.offset)
+            staging.truncate()
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                staging.write(data)
+                remaining -= len(data)
+            if remaining or (md5 and base64.b64encode(digest.digest()) != md5):
+                staging.truncate(self.offset)
+                raise ChunkedUploadError("Chunk is incomplete or corrupt")
+
+        self.offset += length
+        self.save()
+
+    def finish(self):
+        """
+        Creates the ``Attachment`` from the completed staging file through
+        ``AttachmentManager.create_for_object`` and removes this upload. The
+        staging file goes once that is committed, so that the upload can be
+        finished again if it is rolled back.
+        """
+        if not self.complete:
+            raise ChunkedUploadError("Upload is not complete yet")
+        with open(self.staging_path, 'rb') as staging:
+            attachment = Attachment.objects.create_for_object(
+                self.content_object, file=File(staging, name=self.filename),
+                title=self.title, summary=self.summary, attached_by=self.user)
+        self.delete()
+        run_after_commit(self.delete_staging_file)
+        return attachment
+
+    def abort(self):
+        self.delete_staging_file()
+        self.delete()
+
+    def delete_staging_file(self):
+        if os.path.exists(self.staging_path):
+            os.remove(self.staging_path)
+
+class TestModel(Attachable):
     """
     This model is simply used by this application's test suite as a model to
     which to attach files.
@@ -0,0 +1,246 @@
+"""
+Post-upload processing of attachments.
+
+The processors named in ``ATTACHMENT_PROCESSORS`` run one after the other
+for each new attachment. A processor is a callable taking the attachment and
+returning a dictionary (or None). Keys naming ``Attachment`` fields are
+stored in those fields; anything else is kept in ``processing_log`` under the
+processor's name, along with how long it took.
+
+``ATTACHMENT_PROCESSING`` decides when that happens:
+
+``'queue'`` (the default)
+    Later, when the ``process_attachments`` management command runs. It
+    picks up every attachment that hasn't been processed, which includes
+    those the thread pool had no room for.
+``'thread'``
+    In a pool of ``ATTACHMENT_PROCESSING_THREADS`` threads, with at most
+    ``ATTACHMENT_PROCESSING_QUEUE_SIZE`` attachments waiting. The pool is
+    only started when this is chosen.
+``'sync'``
+    Right away, in the request.
+``None``
+    Never.
+"""
+import Queue
+import hashlib
+import logging
+import mimetypes
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+
+from attachments import cache
+from attachments.derivatives import DerivativeError, get_derivative
+from attachments.models import Attachment
+from attachments.utils import get_callable_from_string
+
+PROCESSING = getattr(settings, 'ATTACHMENT_PROCESSING', 'queue')
+PROCESSING_THREADS = getattr(settings, 'ATTACHMENT_PROCESSING_THREADS', 2)
+PROCESSING_QUEUE_SIZE = getattr(settings, 'ATTACHMENT_PROCESSING_QUEUE_SIZE',
+                                100)
+PROCESSORS = getattr(settings, 'ATTACHMENT_PROCESSORS', (
+    'attachments.processing.compute_sha256',
+    'attachments.processing.sniff_mime_type',
+    'attachments.processing.make_thumbnail',
+    'attachments.processing.extract_text',
+))
+READ_CHUNK_SIZE = 64 * 1024
+TEXT_EXTRACT_LIMIT = getattr(settings, 'ATTACHMENT_TEXT_EXTRACT_LIMIT',
+                             64 * 1024)
+
+logger = logging.getLogger('attachments.processing')
+
+# Leading bytes of common file types, for when the name says otherwise.
+MAGIC_NUMBERS = (
+    ('\x89PNG\r\n\x1a\n', 'image/png'),
+    ('\xff\xd8\xff', 'image/jpeg'),
+    ('GIF87a', 'image/gif'),
+    ('GIF89a', 'image/gif'),
+    ('%PDF-', 'application/pdf'),
+    ('PK\x03\x04', 'application/zip'),
+    ('\x1f\x8b', 'application/x-gzip'),
+)
+
+
+def compute_sha256(attachment):
+    """
+    Hashes the file, unless its hash is already known (usually it was
+    computed while the file was stored).
+    """
+    if attachment.sha256:
+        return None
+    digest = hashlib.sha256()
+    f = attachment.file.storage.open(attachment.file.name, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return {'sha256': digest.hexdigest()}
+
+
+def sniff_mime_type(attachment):
+    """
+    Guesses the MIME type from the first bytes of the file, falling back to
+    the file name.
+    """
+    f = attachment.file.storage.open(attachment.file.name, 'rb')
+    try:
+        head = f.read(16)
+    finally:
+        f.close()
+    for magic, mime_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return {'mime_type': mime_type}
+    mime_type, encoding = mimetypes.guess_type(attachment.file.name)
+    return {'mime_type': mime_type or 'application/octet-stream'}
+
+
+def make_thumbnail(attachment):
+    """
+    Makes the ``thumbnail`` derivative of images ahead of the first request
+    for it.
+    """
+    if not (attachment.mime_type or '').startswith('image/'):
+        return None
+    try:
+        derivative = get_derivative(attachment, 'thumbnail')
+    except DerivativeError, e:
+        return {'skipped': unicode(e)}
+    return {'name': derivative.file_name}
+
+
+def extract_text(attachment):
+    """
+    Keeps up to ``TEXT_EXTRACT_LIMIT`` bytes of text files, eg. for search.
+    """
+    if not (attachment.mime_type or '').startswith('text/'):
+        return None
+    f = attachment.file.storage.open(attachment.file.name, 'rb')
+    try:
+        text = f.read(TEXT_EXTRACT_LIMIT)
+    finally:
+        f.close()
+    return {'extracted_text': text.decode('utf-8', 'replace')}
+
+
+_processor_cache = {}
+
+def get_processors():
+    """
+    The ``(name, callable)`` pairs of ``ATTACHMENT_PROCESSORS``, resolved
+    once.
+    """
+    try:
+        return _processor_cache['processors']
+    except KeyError:
+        processors = [(path.rsplit('.', 1)[-1], get_callable_from_string(path))
+                      for path in PROCESSORS]
+        _processor_cache['processors'] = processors
+        return processors
+
+
+def process(attachment):
+    """
+    Runs all processors on ``attachment`` and stores the results.
+    """
+    field_names = set(f.name for f in Attachment._meta.fields)
+    updates = {}
+    log = {}
+    for name, processor in get_processors():
+        started = time.time()
+        entry = log[name] = {}
+        try:
+            result = processor(attachment) or {}
+        except Exception, e:
+            logger.exception("Processor %s failed on attachment %s",
+                              name, attachment.pk)
+            entry['error'] = unicode(e)
+            result = {}
+        entry['seconds'] = round(time.time() - started, 6)
+        for key, value in result.items():
+            if key in field_names:
+                # Later processors get to see what earlier ones found out.
+                setattr(attachment, key, value)
+                updates[key] = value
+            else:
+                entry[key] = value
+
+    updates['processed'] = attachment.processed = datetime.now()
+    updates['processing_log'] = attachment.processing_log = \
+        simplejson.dumps(log)
+    Attachment.objects.filter(pk=attachment.pk).update(**updates)
+    cache.invalidate(attachment.content_type_id, attachment.object_id)
+    return log
+
+
+_pool = []
+_pool_lock = threading.Lock()
+_queue = Queue.Queue(PROCESSING_QUEUE_SIZE)
+
+def _start_pool():
+    _pool_lock.acquire()
+    try:
+        while len(_pool) < PROCESSING_THREADS:
+            worker = threading.Thread(target=_work)
+            worker.setDaemon(True)
+            worker.start()
+            _pool.append(worker)
+    finally:
+        _pool_lock.release()
+
+
+def _work():
+    while True:
+        _process_in_thread(_queue.get())
+
+
+def _process_in_thread(pk):
+    try:
+        try:
+            attachment = Attachment.objects.get(pk=pk)
+        except Attachment.DoesNotExist:
+            # Not committed yet (or gone); process_attachments will find it.
+            return
+        process(attachment)
+    except Exception:
+        logger.exception("Processing attachment %s failed", pk)
+    finally:
+        connection.close()
+
+
+def process_later(attachment):
+    """
+    Arranges for ``attachment`` to be processed as configured by
+    ``ATTACHMENT_PROCESSING``.
+    """
+    if PROCESSING == 'sync':
+        process(attachment)
+    elif PROCESSING == 'thread':
+        _start_pool()
+        try:
+            _queue.put_nowait(attachment.pk)
+        except Queue.Full:
+            logger.warning("Processing queue full; leaving attachment %s "
+                           "for process_attachments", attachment.pk)
+
+
+def process_pending(batch_size=100):
+    """
+    Processes every attachment that hasn't been yet, ``batch_size`` at a
+    time. Returns how many were processed.
+    """
+    count = 0
+    while True:
+        batch = list(Attachment.objects.filter(processed__isnull=True)
+                     .exclude(file='').order_by('pk')[:batch_size])
+        if not batch:
+            return count
+        for attachment in batch:
+            process(attachment)
+            count += 1
@@ -0,0 +1,118 @@
+"""
+Fetching attachment files over HTTP, for storages that can't open their files
+directly.
+
+Connections are kept alive and reused per thread and host, and failed requests
+are retried ``ATTACHMENT_REMOTE_RETRIES`` times, waiting
+``ATTACHMENT_REMOTE_BACKOFF`` seconds before the first retry and twice as long
+before each following one.
+"""
+import httplib
+import shutil
+import socket
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+
+from attachments.instrumentation import instrumented
+
+REMOTE_RETRIES = getattr(settings, 'ATTACHMENT_REMOTE_RETRIES', 3)
+REMOTE_BACKOFF = getattr(settings, 'ATTACHMENT_REMOTE_BACKOFF', 0.5)
+REMOTE_TIMEOUT = getattr(settings, 'ATTACHMENT_REMOTE_TIMEOUT', 30)
+MAX_REDIRECTS = 5
+
+_connections = threading.local()
+
+
+class RemoteFetchError(IOError):
+    pass
+
+
+def _get_connection(scheme, netloc):
+    pool = _connections.__dict__.setdefault('pool', {})
+    key = (scheme, netloc)
+    if key not in pool:
+        if scheme == 'https':
+            connection_cls = httplib.HTTPSConnection
+        else:
+            connection_cls = httplib.HTTPConnection
+        try:
+            pool[key] = connection_cls(netloc, timeout=REMOTE_TIMEOUT)
+        except TypeError:
+            # No timeout argument before Python 2.6; _fetch_once sets it on
+            # the socket instead.
+            pool[key] = connection_cls(netloc)
+    return pool[key]
+
+
+def _discard_connection(scheme, netloc):
+    connection = _connections.__dict__.get('pool', {}).pop((scheme, netloc),
+                                                           None)
+    if connection is not None:
+        connection.close()
+
+
+def close_connections():
+    """
+    Closes the kept-alive connections of the current thread.
+    """
+    for connection in _connections.__dict__.pop('pool', {}).values():
+        connection.close()
+
+
+def _fetch_once(url, fileobj):
+    for redirect in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        connection = _get_connection(parts.scheme, parts.netloc)
+        try:
+            if connection.sock is None and not hasattr(connection, 'timeout'):
+                connection.connect()
+                connection.sock.settimeout(REMOTE_TIMEOUT)
+            connection.request('GET', path)
+            response = connection.getresponse()
+            if response.status in (301, 302, 303, 307) and \
+                    response.getheader('location'):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status != 200:
+                response.read()
+                raise RemoteFetchError("GET %s returned %s"
+                                       % (url, response.status))
+            shutil.copyfileobj(response, fileobj)
+            if response.will_close:
+                _discard_connection(parts.scheme, parts.netloc)
+            return
+        except (httplib.HTTPException, socket.error):
+            # The connection can't be reused after a failed exchange.
+            _discard_connection(parts.scheme, parts.netloc)
+            raise
+    raise RemoteFetchError("Too many redirects fetching %s" % url)
+
+
+@instrumented('remote.fetch')
+def fetch(url, fileobj, retries=None, backoff=None):
+    """
+    Downloads ``url`` into the file-like ``fileobj``, retrying with
+    exponential backoff. Raises ``RemoteFetchError`` once all attempts have
+    failed.
+    """
+    if retries is None:
+        retries = REMOTE_RETRIES
+    if backoff is None:
+        backoff = REMOTE_BACKOFF
+
+    for attempt in range(retries + 1):
+        fileobj.seek(0)
+        fileobj.truncate()
+        try:
+            _fetch_once(url, fileobj)
+            return
+        except (RemoteFetchError, httplib.HTTPException, socket.error), e:
+            if attempt == retries:
+                raise RemoteFetchError("Could not fetch %s: %s" % (url, e))
+            # Possibly an S3 propagation delay; wait a little longer each time.
+            time.sleep(backoff * 2 ** attempt)
@@ -0,0 +1,5 @@
+-- Every listing filters on the generic foreign key and orders by
+-- attached_timestamp; the unique (content_type_id, object_id, slug) index
+-- covers the slug checks.
+CREATE INDEX attachments_attachment_object_timestamp
+    ON attachments_attachment (content_type_id, object_id, attached_timestamp);
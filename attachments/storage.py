@@ -0,0 +1,74 @@
+"""
+Content-addressed storage for attachment files.
+
+With ``ATTACHMENT_CONTENT_ADDRESSED = True`` every file is stored once under
+the SHA-256 of its contents, whatever name it was uploaded with, and
+attachments with identical files share it. ``Blob`` rows count the
+attachments pointing at each stored file so that it is only removed when the
+last one goes away.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+CONTENT_ADDRESSED = getattr(settings, 'ATTACHMENT_CONTENT_ADDRESSED', False)
+BLOB_DIR = getattr(settings, 'ATTACHMENT_BLOB_DIR',
+                   os.path.join('attachments', 'blobs'))
+
+
+def blob_name(digest, extension=''):
+    """
+    The storage name for a file with the given SHA-256 hex ``digest``,
+    sharded into two directory levels.
+    """
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4],
+                        digest + extension.lower())
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    A ``FileSystemStorage`` that names files after the SHA-256 of their
+    contents (keeping the extension) instead of the name they are saved with.
+
+    The file is hashed while it is written to a temporary file next to its
+    final location, so it is read only once. Saving contents that are already
+    stored just returns the existing name.
+    """
+
+    def get_available_name(self, name):
+        # The name is only used for its extension; duplicates are fine.
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1]
+        directory = self.path(BLOB_DIR)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            tmp_file = os.fdopen(fd, 'wb')
+            try:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+            finally:
+                tmp_file.close()
+
+            name = blob_name(digest.hexdigest(), extension)
+            full_path = self.path(name)
+            if not self.exists(name):
+                if not os.path.isdir(os.path.dirname(full_path)):
+                    os.makedirs(os.path.dirname(full_path))
+                file_move_safe(tmp_path, full_path, allow_overwrite=True)
+                if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                    os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name.replace('\\', '/')
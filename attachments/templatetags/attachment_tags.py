@@ -1,8 +1,8 @@
 from django import template
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import reverse
 
 from attachments.models import Attachment
+from attachments.utils import cached_reverse
 
 
 def get_contenttype_kwargs(content_object):
@@ -17,7 +17,7 @@ def get_contenttype_kwargs(content_object):
 
 def new_attachment_url(content_object):
     kwargs = get_contenttype_kwargs(content_object)
-    return reverse('attachment_new', kwargs=kwargs)
+    return cached_reverse('attachment_new', **kwargs)
 
 class ObjectAttachmentsNode(template.Node):
     def __init__(self, content_object, context_name):
@@ -25,7 +25,8 @@ class ObjectAttachmentsNode(template.Node):
         self.context_name = context_name
     def render(self, context):
         content_object = self.content_object.resolve(context)
-        context[self.context_name] = Attachment.objects.attachments_for_object(content_object)
+        context[self.context_name] = Attachment.objects.attachment_list_for_object(
+            content_object)
         return ''
 
 def do_get_attachments(parser, token):
@@ -1,13 +1,53 @@
+from __future__ import with_statement
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.template import Context, Template
 from django.test import TestCase
-from django.test.client import Client
+from django.test.utils import override_settings
+from django.test.client import Client, RequestFactory
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection, IntegrityError
+from django.db.models.manager import EmptyManager
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.files.uploadedfile import SimpleUploadedFile, \
+    TemporaryUploadedFile
+from django.utils import simplejson
 
-from attachments.models import Attachment, TestModel
+from attachments.models import Attachment, AttachmentCount, Blob, \
+    ChunkedUpload, ChunkedUploadError, Derivative, TestModel, \
+    derivative_storage
+from attachments import cache, derivatives, directory_schemes, downloads, \
+    instrumentation, processing, remote, views
+from attachments import models as attachment_models
+from attachments.storage import ContentAddressedStorage, blob_name
+from attachments.utils import LRUCache, unique_slugify, unique_slugs, \
+    cached_reverse, discard_after_commit, flush_after_commit, map_in_threads
+from attachments.downloads import parse_range_header, serve_attachment, \
+    serve_derivative, serve_file
+from attachments.forms import ChunkedUploadForm
+from attachments.views import list_attachments_json, new_attachments
+from attachments.middleware import Accept, AcceptMiddleware, \
+    parse_accept_header
 
 import os
+import base64
+from datetime import datetime, timedelta
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import hashlib
+import pickle
+import Queue
+from StringIO import StringIO
 from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
 
 """
 
@@ -48,6 +88,34 @@ from tempfile import NamedTemporaryFile
 [<Attachment: Something Else>, <Attachment: Something>]
 """
 
+class AttachmentTestCase(TestCase):
+    """
+    Sets up ``bob`` and two objects to attach files to, and deletes the files
+    of the attachments that are left afterwards.
+    """
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.tm2 = TestModel.objects.create(name="Test2")
+        self.storage = Attachment._meta.get_field('file').storage
+
+    def tearDown(self):
+        for attachment in Attachment.objects.all():
+            attachment.file.delete(save=False)
+
+    def _attach(self, contents, obj=None, name="test.txt", **kwargs):
+        """
+        Attaches a file called ``name`` to ``obj`` (``tm`` by default);
+        ``contents`` is a string or a ``File``.
+        """
+        if isinstance(contents, basestring):
+            contents = ContentFile(contents)
+        attachment = Attachment(content_object=obj or self.tm,
+                                attached_by=self.bob, **kwargs)
+        attachment.file.save(name, contents)
+        return attachment
+
+
 class TestAttachmentCopying(TestCase):
     def setUp(self):
         self.client = Client(REMOTE_ADDR='localhost')
@@ -89,4 +157,1174 @@ class TestAttachmentCopying(TestCase):
                 attachment.file.name,
                 Attachment.get_attachment_dir(attachment,
                                               attachment.file_name())
-            )
\ No newline at end of file
+            )
+
+class TestAttachmentPrefetching(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.objects = [TestModel.objects.create(name="Test%s" % i)
+                        for i in range(3)]
+        for obj in self.objects[:2]:
+            for title in ("First", "Second"):
+                Attachment.objects.create_for_object(
+                    obj, file="%s.txt" % title, attached_by=self.bob,
+                    title=title)
+
+    def testPrefetchUsesOneQueryPerContentType(self):
+        with self.assertNumQueries(1):
+            Attachment.objects.prefetch_attachments(self.objects)
+
+        with self.assertNumQueries(0):
+            counts = [
+                len(Attachment.objects.attachment_list_for_object(obj))
+                for obj in self.objects]
+        self.assertEqual(counts, [2, 2, 0])
+
+    def testAttachmentsForObjectsGroupsByObject(self):
+        content_type = ContentType.objects.get_for_model(TestModel)
+        result = Attachment.objects.attachments_for_objects(self.objects)
+        self.assertEqual(
+            [a.title for a in result[(content_type.pk, self.objects[0].pk)]],
+            ["Second", "First"])
+        self.assertFalse((content_type.pk, self.objects[2].pk) in result)
+
+
+class TestSlugAllocation(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+
+    def _attach(self, title):
+        return Attachment.objects.create_for_object(
+            self.tm, file="scan.pdf", attached_by=self.bob, title=title)
+
+    def testCollidingTitlesGetNumberedSlugs(self):
+        slugs = [self._attach("Scan").slug for i in range(4)]
+        self.assertEqual(slugs, ["scan", "scan-2", "scan-3", "scan-4"])
+
+    def testSlugLookupIsASingleQuery(self):
+        for i in range(10):
+            self._attach("Scan")
+        attachment = Attachment(
+            content_type=ContentType.objects.get_for_model(self.tm),
+            object_id=self.tm.pk, title="Scan")
+        queryset = Attachment.objects.filter(object_id=self.tm.pk)
+        with self.assertNumQueries(1):
+            unique_slugify(attachment, attachment.title, queryset=queryset)
+        self.assertEqual(attachment.slug, "scan-11")
+
+    def testConcurrentSaveTakingTheSlugIsRetried(self):
+        def unique_slugify_then_collide(instance, *args, **kwargs):
+            unique_slugify(instance, *args, **kwargs)
+            if instance.slug == "scan":
+                # Another request saves an attachment with the same slug
+                # after ours was calculated.
+                Attachment.objects.bulk_create([Attachment(
+                    content_type=instance.content_type,
+                    object_id=instance.object_id, attached_by=self.bob,
+                    title="Scan", slug="scan", file="other.pdf")])
+        attachment_models.unique_slugify = unique_slugify_then_collide
+        try:
+            attachment = self._attach("Scan")
+        finally:
+            attachment_models.unique_slugify = unique_slugify
+        self.assertEqual(attachment.slug, "scan-2")
+        self.assertEqual(
+            sorted(Attachment.objects.values_list('slug', flat=True)),
+            ["scan", "scan-2"])
+        # The bulk inserted row isn't counted, and neither was the failed
+        # insert.
+        self.assertEqual(AttachmentCount.objects.for_object(self.tm).count,
+                         1)
+
+    def testLongTitlesAreShortenedToFit(self):
+        title = "x" * 60
+        first, second = self._attach(title), self._attach(title)
+        self.assertEqual(first.slug, "x" * 50)
+        self.assertEqual(second.slug, "x" * 48 + "-2")
+
+
+class NoPathStorage(Storage):
+    """
+    Reads through another storage but, like remote storages, has no local
+    paths.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _open(self, name, mode='rb'):
+        return self.storage.open(name, mode)
+
+
+class TestAttachmentDownload(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.attachment = Attachment(
+            content_type=ContentType.objects.get_for_model(self.tm),
+            object_id=self.tm.pk, attached_by=self.bob, title="Digits")
+        self.attachment.file.save("digits.txt", ContentFile("0123456789"))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.attachment.file.delete(save=False)
+
+    def testParseRangeHeader(self):
+        self.assertEqual(parse_range_header("bytes=0-0", 10), (0, 0))
+        self.assertEqual(parse_range_header("bytes=4-", 10), (4, 9))
+        self.assertEqual(parse_range_header("bytes=-3", 10), (7, 9))
+        self.assertEqual(parse_range_header("bytes=2-99", 10), (2, 9))
+        self.assertEqual(parse_range_header("bytes=0-1,4-5", 10), None)
+        self.assertRaises(ValueError, parse_range_header, "bytes=10-", 10)
+
+    def testFullDownload(self):
+        response = serve_attachment(self.factory.get('/'), self.attachment)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, "0123456789")
+        self.assertEqual(response['Content-Length'], "10")
+
+    def testPartialDownload(self):
+        request = self.factory.get('/', HTTP_RANGE="bytes=2-4")
+        response = serve_attachment(request, self.attachment)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, "234")
+        self.assertEqual(response['Content-Range'], "bytes 2-4/10")
+
+    def testStaleIfRangeSendsWholeFile(self):
+        request = self.factory.get('/', HTTP_RANGE="bytes=2-4",
+                                   HTTP_IF_RANGE='"stale"')
+        response = serve_attachment(request, self.attachment)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, "0123456789")
+
+    def testRedirect(self):
+        downloads.DOWNLOAD_REDIRECT = True
+        try:
+            response = serve_attachment(self.factory.get('/'),
+                                        self.attachment)
+        finally:
+            downloads.DOWNLOAD_REDIRECT = False
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], self.attachment.file.url)
+
+    def testUnicodeFileName(self):
+        storage = self.attachment.file.storage
+        response = serve_file(self.factory.get('/'), storage,
+                              self.attachment.file.name, 10, 0, '"etag"',
+                              u"R\xe9sum\xe9 \u2013 2012.txt")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'],
+                         "attachment; filename=\"Resume  2012.txt\"; "
+                         "filename*=UTF-8''R%C3%A9sum%C3%A9%20%E2%80%93"
+                         "%202012.txt")
+        self.assertEqual(
+            serve_attachment(self.factory.get('/'),
+                             self.attachment)['Content-Disposition'],
+            'attachment; filename="digits.txt"')
+
+    def testCompressedFilesKeepTheirEncoding(self):
+        storage = self.attachment.file.storage
+        name = storage.save("digits.txt.gz", ContentFile("0123456789"))
+        try:
+            for request in (self.factory.get('/'),
+                            self.factory.get('/', HTTP_RANGE="bytes=2-4")):
+                response = serve_file(request, storage, name, 10, 0,
+                                      '"etag"')
+                self.assertEqual(response['Content-Type'], "application/gzip")
+                self.assertFalse(response.has_header('Content-Encoding'))
+        finally:
+            storage.delete(name)
+
+    def testSendfileStreamsFilesWithoutALocalPath(self):
+        storage = NoPathStorage(self.attachment.file.storage)
+        downloads.SENDFILE_HEADER = 'X-Sendfile'
+        try:
+            local = serve_attachment(self.factory.get('/'), self.attachment)
+            remote = serve_file(self.factory.get('/'), storage,
+                                self.attachment.file.name, 10, 0, '"etag"')
+        finally:
+            downloads.SENDFILE_HEADER = None
+        self.assertEqual(local['X-Sendfile'], self.attachment.file.path)
+        self.assertEqual(local.content, "")
+        self.assertFalse(remote.has_header('X-Sendfile'))
+        self.assertEqual(remote.content, "0123456789")
+
+    def testNotModified(self):
+        etag = serve_attachment(self.factory.get('/'), self.attachment)['ETag']
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+        response = serve_attachment(request, self.attachment)
+        self.assertEqual(response.status_code, 304)
+
+
+class TestChunkedUpload(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.upload = ChunkedUpload.objects.create(
+            content_type=ContentType.objects.get_for_model(self.tm),
+            object_id=self.tm.pk, user=self.bob, filename="digits.txt",
+            size=10)
+
+    def tearDown(self):
+        flush_after_commit()
+        for upload in ChunkedUpload.objects.all():
+            upload.delete_staging_file()
+        for attachment in Attachment.objects.all():
+            attachment.file.delete(save=False)
+
+    def testUploadInChunks(self):
+        self.upload.append(StringIO("01234"), 0, 5)
+        self.assertRaises(ChunkedUploadError,
+                          self.upload.append, StringIO("9"), 9, 1)
+        self.upload.append(StringIO("56789"), 5, 5)
+        self.assertTrue(self.upload.complete)
+
+        attachment = self.upload.finish()
+        self.assertEqual(attachment.content_object, self.tm)
+        self.assertEqual(attachment.file.read(), "0123456789")
+        self.assertFalse(ChunkedUpload.objects.exists())
+        # Kept until the commit, in case the upload has to be finished again.
+        self.assertTrue(os.path.exists(self.upload.staging_path))
+        flush_after_commit()
+        self.assertFalse(os.path.exists(self.upload.staging_path))
+
+    def testCorruptChunkIsDiscarded(self):
+        self.upload.append(StringIO("01234"), 0, 5)
+        md5 = base64.b64encode(hashlib.md5("56789").digest())
+        self.assertRaises(ChunkedUploadError, self.upload.append,
+                          StringIO("5678X"), 5, 5, md5=md5)
+        self.assertEqual(self.upload.offset, 5)
+        self.assertEqual(os.path.getsize(self.upload.staging_path), 5)
+        self.upload.append(StringIO("56789"), 5, 5, md5=md5)
+        self.assertEqual(self.upload.finish().file.read(), "0123456789")
+
+    def testProcessedAfterCommit(self):
+        processed = []
+        process_later = views.process_later
+        views.process_later = lambda attachment: processed.append(
+            attachment.pk)
+        try:
+            request = RequestFactory().put(
+                '/', data='0123456789',
+                content_type='application/octet-stream',
+                HTTP_CONTENT_RANGE='bytes 0-9/10')
+            request.user = self.bob
+            # The test case runs in a managed transaction, like a request
+            # under TransactionMiddleware.
+            response = views.chunked_upload(request, self.upload.upload_id)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(processed, [])
+            flush_after_commit()
+        finally:
+            views.process_later = process_later
+        self.assertEqual(processed, [Attachment.objects.get().pk])
+
+    def testFileNameCantLeaveTheDirectory(self):
+        form = ChunkedUploadForm({'filename': '../../../evil.txt', 'size': 4})
+        self.assertTrue(form.is_valid())
+        upload = form.save(self.tm, self.bob)
+        self.assertEqual(upload.filename, 'evil.txt')
+        upload.append(StringIO("evil"), 0, 4)
+        attachment = upload.finish()
+        self.assertEqual(os.path.dirname(attachment.file.name),
+                         os.path.dirname(directory_schemes.by_app(
+                             attachment, 'evil.txt')))
+        self.assertFalse(ChunkedUploadForm(
+            {'filename': '..', 'size': 4}).is_valid())
+
+    def testEmptyFilesAreRejected(self):
+        form = ChunkedUploadForm({'filename': 'empty.txt', 'size': 0})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('size' in form.errors)
+
+    def testAbandonedUploadsAreSwept(self):
+        long_ago = datetime.now() - timedelta(days=3)
+        def make_old(path):
+            stamp = time.mktime(long_ago.timetuple())
+            os.utime(path, (stamp, stamp))
+
+        abandoned = ChunkedUpload.objects.create(
+            content_object=self.tm, user=self.bob, filename="abandoned.txt",
+            size=10, started=long_ago)
+        abandoned.append(StringIO("01234"), 0, 5)
+        make_old(abandoned.staging_path)
+        active = ChunkedUpload.objects.create(
+            content_object=self.tm, user=self.bob, filename="active.txt",
+            size=10, started=long_ago)
+        active.append(StringIO("01234"), 0, 5)
+        orphan = os.path.join(attachment_models.UPLOAD_STAGING_DIR, "orphan")
+        open(orphan, 'wb').close()
+        make_old(orphan)
+
+        call_command('sweep_attachments', upload_age=24, verbosity=0)
+        self.assertEqual(set(ChunkedUpload.objects.all()),
+                         set([self.upload, active]))
+        self.assertFalse(os.path.exists(abandoned.staging_path))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(active.staging_path))
+
+
+class TestContentAddressedStorage(TestCase):
+    def setUp(self):
+        self.storage = ContentAddressedStorage(location=settings.MEDIA_ROOT)
+
+    def testIdenticalFilesAreStoredOnce(self):
+        first = self.storage.save("a.txt", ContentFile("same contents"))
+        second = self.storage.save("b.TXT", ContentFile("same contents"))
+        other = self.storage.save("c.txt", ContentFile("other contents"))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(
+            first, blob_name(hashlib.sha256("same contents").hexdigest(),
+                             ".txt"))
+
+        Blob.objects.incref(first, 2)
+        Blob.objects.decref(first)
+        self.assertTrue(self.storage.exists(first))
+        Blob.objects.decref(first)
+        flush_after_commit()
+        self.assertFalse(self.storage.exists(first))
+        self.assertFalse(Blob.objects.filter(name=first).exists())
+        self.storage.delete(other)
+
+
+class TestBulkCopying(AttachmentTestCase):
+    def setUp(self):
+        super(TestBulkCopying, self).setUp()
+        for i in range(5):
+            self._attach("page %s" % i, name="scan.txt", title="Scan")
+        Attachment.objects.create_for_object(
+            self.tm2, file="old.txt", attached_by=self.bob, title="Old")
+
+    def testShallowCopyIsConstantQueries(self):
+        # Select the source attachments, collect and delete the target's old
+        # one (and update its count), insert the copies and update the count.
+        with self.assertNumQueries(6):
+            Attachment.objects.copy_attachments(self.tm, self.tm2)
+        originals = Attachment.objects.attachments_for_object(self.tm)
+        copies = Attachment.objects.attachments_for_object(self.tm2)
+        self.assertEqual(
+            sorted((a.slug, a.file.name) for a in copies),
+            sorted((a.slug, a.file.name) for a in originals))
+
+    def testDeepCopyCopiesFiles(self):
+        Attachment.objects.copy_attachments(self.tm, self.tm2, deepcopy=True)
+        copies = Attachment.objects.attachments_for_object(self.tm2)
+        self.assertEqual(len(copies), 5)
+        originals = set(a.file.name for a in
+                        Attachment.objects.attachments_for_object(self.tm))
+        for attachment in copies:
+            self.assertFalse(attachment.file.name in originals)
+            self.assertEqual(
+                attachment.file.name,
+                Attachment.get_attachment_dir(attachment,
+                                              attachment.file_name()))
+        self.assertEqual(sorted(a.file.read() for a in copies),
+                         ["page %s" % i for i in range(5)])
+
+    def testFailedDeepCopyLeavesNoFiles(self):
+        storage = Attachment._meta.get_field('file').storage
+        directory = os.path.dirname(Attachment.get_attachment_dir(
+            Attachment(content_object=self.tm2), "scan.txt"))
+        def stored():
+            try:
+                return storage.listdir(directory)[1]
+            except OSError:
+                return []
+        before = stored()
+
+        def fail(attachments):
+            raise IntegrityError("insert failed")
+        Attachment.objects._bulk_create = fail
+        try:
+            self.assertRaises(IntegrityError,
+                              Attachment.objects.copy_attachments,
+                              self.tm, self.tm2, deepcopy=True)
+        finally:
+            del Attachment.objects._bulk_create
+        self.assertEqual(stored(), before)
+
+    def testMapInThreads(self):
+        self.assertEqual(map_in_threads(lambda n: n * n, range(10), 4),
+                         [n * n for n in range(10)])
+
+        done = []
+        def square(n):
+            if n == 3:
+                raise ValueError(n)
+            done.append(n)
+            return n * n
+        self.assertRaises(ValueError, map_in_threads, square, range(10), 4)
+        self.assertEqual(sorted(done), [n for n in range(10) if n != 3])
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    failures = 0
+
+    def do_GET(self):
+        if FlakyHandler.failures:
+            FlakyHandler.failures -= 1
+            body, status = "try again", 503
+        else:
+            body, status = "remote contents", 200
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestRemoteFetch(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.serving = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s/file.txt" % self.server.server_port
+
+    def _serve(self):
+        # Rather than serve_forever(), which can't be stopped before Python
+        # 2.6.
+        while self.serving:
+            self.server.handle_request()
+
+    def tearDown(self):
+        remote.close_connections()
+        self.serving = False
+        # Wake the server up so that it sees it should stop.
+        FlakyHandler.failures = 0
+        remote.fetch(self.url, StringIO(), retries=0)
+        remote.close_connections()
+        self.thread.join()
+        self.server.server_close()
+
+    def testFetchRetriesFailures(self):
+        FlakyHandler.failures = 2
+        target = StringIO()
+        remote.fetch(self.url, target, retries=2, backoff=0)
+        self.assertEqual(target.getvalue(), "remote contents")
+
+    def testFetchGivesUp(self):
+        FlakyHandler.failures = 3
+        self.assertRaises(remote.RemoteFetchError, remote.fetch, self.url,
+                          StringIO(), retries=2, backoff=0)
+
+
+class TestDirectorySchemeSetting(TestCase):
+    def testSchemeFollowsSetting(self):
+        self.assertEqual(directory_schemes.get_directory_scheme(),
+                         directory_schemes.by_app)
+        with override_settings(
+                ATTACHMENT_STORAGE_DIR='attachments.directory_schemes.one_folder'):
+            self.assertEqual(directory_schemes.get_directory_scheme(),
+                             directory_schemes.one_folder)
+        self.assertEqual(directory_schemes.get_directory_scheme(),
+                         directory_schemes.by_app)
+
+    def testMisconfiguredSchemeFailsLoudly(self):
+        with override_settings(
+                ATTACHMENT_STORAGE_DIR='attachments.directory_schemes.missing'):
+            self.assertRaises(ImproperlyConfigured,
+                              directory_schemes.get_directory_scheme)
+
+    def testSchemesDontFetchTheContentObject(self):
+        tm = TestModel.objects.create(name="Test1")
+        attachment = Attachment(
+            object_id=tm.pk, content_type=ContentType.objects.get_for_model(tm))
+        with self.assertNumQueries(0):
+            path = directory_schemes.by_app(attachment, "a.txt")
+            sharded = directory_schemes.sharded(attachment, "a.txt")
+        self.assertEqual(path, "attachments/attachments_testmodel/%s/a.txt"
+                         % tm.pk)
+        self.assertEqual(
+            sharded, "attachments/attachments_testmodel/%s/%s/a.txt"
+            % (hashlib.sha1(str(tm.pk)).hexdigest()[:2], tm.pk))
+
+
+class TestUsage(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Match")
+        self.tm2 = TestModel.objects.create(name="Other")
+        for obj in (self.tm, self.tm2):
+            Attachment.objects.create_for_object(
+                obj, file="a.txt", attached_by=self.bob, title=obj.name)
+
+    def testUsageForQueryset(self):
+        usage = Attachment.objects.usage_for_queryset(
+            TestModel.objects.filter(name="Match"), counts=True)
+        with self.assertNumQueries(1):
+            self.assertEqual([(a.title, a.count) for a in usage.iterator()],
+                             [("Match", 1)])
+
+    def testUsageForModel(self):
+        usage = Attachment.objects.usage_for_model(TestModel)
+        self.assertEqual([a.title for a in usage], ["Match", "Other"])
+        self.assertEqual(list(Attachment.objects.usage_for_model(
+            TestModel, min_count=2)), [])
+
+
+class TestAttachmentListCache(TestCase):
+    def setUp(self):
+        self.timeouts = cache.CACHE_TIMEOUT, cache.VERSION_TIMEOUT
+        cache.CACHE_TIMEOUT, cache.VERSION_TIMEOUT = 60, 600
+        cache.reset_stats()
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        Attachment.objects.create_for_object(
+            self.tm, file="a.txt", attached_by=self.bob, title="First")
+
+    def tearDown(self):
+        discard_after_commit()
+        cache.CACHE_TIMEOUT, cache.VERSION_TIMEOUT = self.timeouts
+
+    def _list(self):
+        # A fresh instance, so nothing is prefetched on it.
+        tm = TestModel.objects.get(pk=self.tm.pk)
+        return [a.title for a in
+                Attachment.objects.attachment_list_for_object(tm)]
+
+    def testListIsCachedUntilAttachmentsChange(self):
+        self.assertEqual(self._list(), ["First"])
+        with self.assertNumQueries(1):
+            self.assertEqual(self._list(), ["First"])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+        Attachment.objects.create_for_object(
+            self.tm, file="b.txt", attached_by=self.bob, title="Second")
+        self.assertEqual(self._list(), ["Second", "First"])
+
+        tm2 = TestModel.objects.create(name="Test2")
+        Attachment.objects.copy_attachments(tm2, self.tm)
+        self.assertEqual(self._list(), [])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3})
+
+    def testProcessingResultsAreLeftOut(self):
+        Attachment.objects.update(extracted_text="lorem ipsum " * 1000)
+        attachments = Attachment.objects.attachment_list_for_object(self.tm)
+        self.assertFalse("lorem ipsum" in pickle.dumps(attachments))
+        with self.assertNumQueries(1):
+            self.assertTrue(attachments[0].extracted_text)
+
+    def testListCachedBeforeTheCommitIsStale(self):
+        discard_after_commit()
+        Attachment.objects.create_for_object(
+            self.tm, file="b.txt", attached_by=self.bob, title="Second")
+        # Another connection reading before the commit gets the old list.
+        content_type = ContentType.objects.get_for_model(self.tm)
+        cache.get_attachment_list(content_type.pk, self.tm.pk, lambda: [])
+        flush_after_commit()
+        self.assertEqual(self._list(), ["Second", "First"])
+
+
+class TestAttachmentCounts(AttachmentTestCase):
+    def _totals(self):
+        counts = AttachmentCount.objects.for_objects([self.tm, self.tm2])
+        return sorted((c.object_id, c.count, c.total_size)
+                      for c in counts.values())
+
+    def testCountsFollowChanges(self):
+        first = self._attach("12345")
+        self._attach("123")
+        self.assertEqual(self._totals(),
+                         [(self.tm.pk, 2, 8), (self.tm2.pk, 0, 0)])
+
+        first.delete()
+        Attachment.objects.copy_attachments(self.tm, self.tm2)
+        self.assertEqual(self._totals(),
+                         [(self.tm.pk, 1, 3), (self.tm2.pk, 1, 3)])
+
+        AttachmentCount.objects.all().update(count=7)
+        AttachmentCount.objects.rebuild()
+        self.assertEqual(self._totals(),
+                         [(self.tm.pk, 1, 3), (self.tm2.pk, 1, 3)])
+
+    def testBulkLookupIsOneQuery(self):
+        self._attach("12345")
+        with self.assertNumQueries(1):
+            AttachmentCount.objects.for_objects([self.tm, self.tm2])
+
+
+class TestJSONListing(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.content_type = ContentType.objects.get_for_model(self.tm)
+        for i in range(5):
+            Attachment.objects.create_for_object(
+                self.tm, file="file%s.txt" % i, attached_by=self.bob,
+                title="File %s" % i,
+                attached_timestamp=datetime(2010, 1, 1, 12, i // 2))
+        self.factory = RequestFactory()
+
+    def _get(self, **params):
+        request = self.factory.get('/', params)
+        request.user = self.bob
+        return list_attachments_json(request, str(self.content_type.pk),
+                                     str(self.tm.pk))
+
+    def testKeysetPagination(self):
+        titles = []
+        after = ''
+        while after is not None:
+            data = simplejson.loads(self._get(limit=2, after=after).content)
+            titles.extend(a['title'] for a in data['attachments'])
+            after = data['next']
+        self.assertEqual(titles, ["File %s" % i for i in (4, 3, 2, 1, 0)])
+
+        row = data['attachments'][0]
+        self.assertEqual(row['attached_by'], "bob")
+        self.assertEqual(row['file_url'], settings.MEDIA_URL + "file0.txt")
+
+    def testCursorTimestamps(self):
+        self.assertEqual(
+            views._parse_json_cursor("2010-01-01T12:00:00.25,7"),
+            (datetime(2010, 1, 1, 12, 0, 0, 250000), 7))
+        self.assertEqual(views._parse_json_cursor("2010-01-01T12:00:00,7"),
+                         (datetime(2010, 1, 1, 12), 7))
+        self.assertEqual(self._get(after="2010-01-01T12:00:00.x,7")
+                         .status_code, 400)
+
+    def testNotModified(self):
+        etag = self._get()['ETag']
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+        request.user = self.bob
+        response = list_attachments_json(request, str(self.content_type.pk),
+                                         str(self.tm.pk))
+        self.assertEqual(response.status_code, 304)
+
+
+class TestAcceptNegotiation(TestCase):
+    def testLRUCacheForgetsLeastRecentlyUsed(self):
+        lru = LRUCache(2)
+        lru.get('a', lambda: 1)
+        lru.get('b', lambda: 2)
+        self.assertEqual(lru.get('a', lambda: None), 1)
+        lru.get('c', lambda: 3)
+        self.assertEqual(sorted(lru.data), ['a', 'c'])
+
+    def testParseIsTolerant(self):
+        self.assertEqual(
+            parse_accept_header("text/html;level=1;q, application/json;q=x,"
+                                " ;q=0.5, text/*;q=0.3"),
+            [("text/html", (("level", "1"),), 1.0),
+             ("application/json", (), 1.0),
+             ("text/*", (), 0.3)])
+
+    def testBestMatch(self):
+        available = ['text/html', 'application/json']
+        browser = "text/html,application/xhtml+xml,*/*;q=0.8"
+        self.assertEqual(Accept(browser).best_match(available), 'text/html')
+        self.assertEqual(Accept("application/json").best_match(available),
+                         'application/json')
+        self.assertEqual(
+            Accept("application/*;q=0.9, text/html;q=0.5").best_match(
+                available), 'application/json')
+        self.assertEqual(Accept("").best_match(available), 'text/html')
+        self.assertEqual(Accept("image/png").best_match(available), None)
+        self.assertEqual(Accept("*/*, text/html;q=0").best_match(available),
+                         'application/json')
+
+    def testMiddlewareIsLazy(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT="application/json")
+        AcceptMiddleware().process_request(request)
+        self.assertEqual(list(request.accepted_types), ["application/json"])
+        self.assertEqual(request.accepted_types[0], "application/json")
+
+
+class TestProcessing(AttachmentTestCase):
+    def testProcessTextFile(self):
+        attachment = self._attach("some notes", name="notes.txt")
+        processing.process(attachment)
+
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.sha256,
+                         hashlib.sha256("some notes").hexdigest())
+        self.assertEqual(attachment.mime_type, "text/plain")
+        self.assertEqual(attachment.extracted_text, "some notes")
+        self.assertTrue(attachment.processed)
+        log = simplejson.loads(attachment.processing_log)
+        self.assertEqual(sorted(log), ["compute_sha256", "extract_text",
+                                       "make_thumbnail", "sniff_mime_type"])
+        self.assertTrue('seconds' in log['compute_sha256'])
+
+    def testMimeTypeComesFromContents(self):
+        attachment = self._attach("%PDF-1.4 ...", name="report.txt")
+        processing.process(attachment)
+        self.assertEqual(attachment.mime_type, "application/pdf")
+        self.assertEqual(attachment.extracted_text, None)
+
+    def testProcessPending(self):
+        self._attach("a", name="a.txt")
+        self._attach("b", name="b.txt")
+        self.assertEqual(processing.process_pending(batch_size=1), 2)
+        self.assertEqual(processing.process_pending(), 0)
+
+    def testNoThreadsUnlessAskedFor(self):
+        self.assertEqual(processing.PROCESSING, 'queue')
+        processing.process_later(self._attach("later", name="later.txt"))
+        self.assertEqual(processing._pool, [])
+
+    def testFullQueueLeavesAttachmentsForTheCommand(self):
+        old = (processing.PROCESSING, processing.PROCESSING_THREADS,
+               processing._queue)
+        processing.PROCESSING = 'thread'
+        # No workers, so nothing takes the queued attachment off the queue.
+        processing.PROCESSING_THREADS = 0
+        processing._queue = Queue.Queue(1)
+        try:
+            first = self._attach("first", name="first.txt")
+            processing.process_later(first)
+            second = self._attach("second", name="second.txt")
+            processing.process_later(second)
+            self.assertEqual(processing._queue.get_nowait(), first.pk)
+            self.assertTrue(processing._queue.empty())
+        finally:
+            (processing.PROCESSING, processing.PROCESSING_THREADS,
+             processing._queue) = old
+        self.assertEqual(processing.process_pending(), 2)
+
+
+def fake_renderer(source, size):
+    return "%sx%s:%s" % (size[0], size[1], source.read())
+
+
+class TestDerivatives(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.attachment = Attachment(content_object=self.tm,
+                                     attached_by=self.bob)
+        self.attachment.file.save("picture.png", ContentFile("pixels"))
+        self.rendered = []
+        def renderer(source, size):
+            self.rendered.append(size)
+            return fake_renderer(source, size)
+        derivatives._renderer_cache['renderer'] = renderer
+
+    def tearDown(self):
+        derivatives._renderer_cache.clear()
+        for derivative in Derivative.objects.all():
+            derivative.delete()
+        flush_after_commit()
+        self.attachment.file.delete(save=False)
+
+    def testMadeOnceNextToTheOriginal(self):
+        first = derivatives.get_derivative(self.attachment, 'thumbnail')
+        second = derivatives.get_derivative(self.attachment, 'thumbnail')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(self.rendered, [(128, 128)])
+        self.assertEqual(first.file_name,
+                         self.attachment.file.name + ".thumbnail.png")
+        self.assertEqual(
+            derivative_storage.open(first.file_name).read(), "128x128:pixels")
+
+    def testUnknownDerivative(self):
+        self.assertRaises(derivatives.DerivativeError,
+                          derivatives.get_derivative, self.attachment, 'huge')
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        thumbnail = derivatives.get_derivative(self.attachment, 'thumbnail')
+        preview = derivatives.get_derivative(self.attachment, 'preview')
+        Derivative.objects.filter(pk=thumbnail.pk).update(
+            last_accessed=datetime(2000, 1, 1))
+
+        self.assertEqual(derivatives.evict(max_bytes=preview.size), 1)
+        self.assertEqual(list(Derivative.objects.values_list('name',
+                                                             flat=True)),
+                         ['preview'])
+        self.assertTrue(derivative_storage.exists(thumbnail.file_name))
+        flush_after_commit()
+        self.assertFalse(derivative_storage.exists(thumbnail.file_name))
+
+    def testRollbackKeepsEvictedFiles(self):
+        thumbnail = derivatives.get_derivative(self.attachment, 'thumbnail')
+        derivatives.evict(max_bytes=1)
+        discard_after_commit()
+        flush_after_commit()
+        self.assertTrue(derivative_storage.exists(thumbnail.file_name))
+        derivative_storage.delete(thumbnail.file_name)
+
+    def testServedWithLongLivedCacheHeaders(self):
+        derivative = derivatives.get_derivative(self.attachment, 'thumbnail')
+        response = serve_derivative(RequestFactory().get('/'), derivative)
+        self.assertEqual(response.content, "128x128:pixels")
+        self.assertEqual(response['Content-Type'], "image/png")
+        self.assertTrue('max-age=31536000' in response['Cache-Control'])
+
+
+class TestMultipleUpload(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.processing = processing.PROCESSING
+        processing.PROCESSING = None
+
+    def tearDown(self):
+        processing.PROCESSING = self.processing
+        for attachment in Attachment.objects.all():
+            attachment.file.delete(save=False)
+
+    def _files(self, *names):
+        return [SimpleUploadedFile(name, "contents of %s" % name)
+                for name in names]
+
+    def testUniqueSlugsInOneQuery(self):
+        Attachment.objects.create_for_object(
+            self.tm, file=ContentFile("x", name="page.txt"), title="Page",
+            attached_by=self.bob)
+        queryset = Attachment.objects.attachments_for_object(self.tm)
+        with self.assertNumQueries(1):
+            slugs = unique_slugs(Attachment, ["Page", "Page", "Cover"],
+                                 queryset=queryset)
+        self.assertEqual(slugs, ["page-2", "page-3", "cover"])
+
+    def testBulkCreate(self):
+        attachments = []
+        for uploaded in self._files("scan.png", "scan.png", "notes.txt"):
+            attachment = Attachment(content_object=self.tm,
+                                    attached_by=self.bob, title=uploaded.name)
+            attachment.file.save(uploaded.name, uploaded, save=False)
+            attachments.append(attachment)
+
+        Attachment.objects.bulk_create_for_object(self.tm, attachments)
+        self.assertEqual([a.slug for a in attachments],
+                         ["scanpng", "scanpng-2", "notestxt"])
+        self.assertEqual(
+            sorted(Attachment.objects.values_list('pk', flat=True)),
+            sorted(a.pk for a in attachments))
+        counts = AttachmentCount.objects.for_object(self.tm)
+        self.assertEqual(counts.count, 3)
+        self.assertEqual(counts.total_size,
+                         sum(len("contents of %s" % a.title)
+                             for a in attachments))
+
+    def testFilesAreDeletedWhenTheInsertFails(self):
+        attachment = Attachment(content_object=self.tm, attached_by=self.bob)
+        attachment.file.save("lost.txt", ContentFile("lost"), save=False)
+        storage = attachment.file.storage
+        name = attachment.file.name
+        def insert():
+            with Attachment.objects._deleting_files_on_error([attachment]):
+                raise IOError("insert failed")
+        self.assertRaises(IOError, insert)
+        self.assertFalse(storage.exists(name))
+
+    def testViewSummarizesEachFile(self):
+        content_type = ContentType.objects.get_for_model(self.tm)
+        request = RequestFactory().post(
+            '/', {'files': self._files("a.txt", "b.txt"), 'summary': "Both"},
+            HTTP_ACCEPT="application/json")
+        request.user = self.bob
+        response = new_attachments(request, content_type.pk, self.tm.pk)
+
+        files = simplejson.loads(response.content)['files']
+        self.assertEqual([f['name'] for f in files], ["a.txt", "b.txt"])
+        self.assertEqual([f['slug'] for f in files], ["atxt", "btxt"])
+        self.assertEqual(Attachment.objects.get(pk=files[0]['id']).summary,
+                         "Both")
+
+
+@contextmanager
+def hidden_test_models():
+    """
+    Gives ``TestModel`` a default manager that hides every row, like a
+    soft-delete manager would.
+    """
+    manager = EmptyManager()
+    manager.model = TestModel
+    original = TestModel._default_manager
+    TestModel._default_manager = manager
+    try:
+        yield
+    finally:
+        TestModel._default_manager = original
+
+
+class TestFileCleanup(AttachmentTestCase):
+    def setUp(self):
+        discard_after_commit()
+        super(TestFileCleanup, self).setUp()
+
+    def tearDown(self):
+        discard_after_commit()
+        super(TestFileCleanup, self).tearDown()
+
+    def testFilesAreDeletedAfterCommit(self):
+        attachment = self._attach("doomed")
+        name = attachment.file.name
+        attachment.delete()
+        self.assertTrue(self.storage.exists(name))
+        flush_after_commit()
+        self.assertFalse(self.storage.exists(name))
+
+    def testRollbackKeepsFiles(self):
+        attachment = self._attach("kept")
+        attachment.delete()
+        discard_after_commit()
+        flush_after_commit()
+        self.assertTrue(self.storage.exists(attachment.file.name))
+
+    def testSharedFilesAreKept(self):
+        attachment = self._attach("shared")
+        attachment.copy(self.tm2)
+        attachment.delete()
+        flush_after_commit()
+        self.assertTrue(self.storage.exists(attachment.file.name))
+
+    def testDeletingTheObjectDeletesItsAttachments(self):
+        name = self._attach("cascaded").file.name
+        self.tm.delete()
+        flush_after_commit()
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(self.storage.exists(name))
+
+    def testDeletingDeferredAttachmentsDeletesTheirFiles(self):
+        name = self._attach("deferred").file.name
+        Attachment.objects.attachments_for_object(self.tm)[0].delete()
+        flush_after_commit()
+        self.assertFalse(self.storage.exists(name))
+
+    def testSweep(self):
+        # Eg. left behind by a model without an ``attachments`` relation.
+        gone = TestModel(pk=self.tm2.pk + 1)
+        dangling = self._attach("dangling", gone)
+        kept = self._attach("kept")
+        orphan = self.storage.save("attachments/orphan.txt",
+                                   ContentFile("orphan"))
+
+        call_command('sweep_attachments', min_age=0, verbosity=0)
+        flush_after_commit()
+        self.assertEqual(list(Attachment.objects.all()), [kept])
+        self.assertFalse(self.storage.exists(dangling.file.name))
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertTrue(self.storage.exists(kept.file.name))
+
+    def testSweepKeepsObjectsHiddenByTheDefaultManager(self):
+        kept = self._attach("kept")
+        with hidden_test_models():
+            call_command('sweep_attachments', min_age=0, verbosity=0)
+        flush_after_commit()
+        self.assertEqual(list(Attachment.objects.all()), [kept])
+        self.assertTrue(self.storage.exists(kept.file.name))
+
+
+class TestInstrumentation(AttachmentTestCase):
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.enabled = instrumentation.ENABLED
+        instrumentation.collector.reset()
+
+    def tearDown(self):
+        instrumentation.ENABLED = self.enabled
+        instrumentation.collector.reset()
+        super(TestInstrumentation, self).tearDown()
+
+    def _attach_and_copy(self):
+        self._attach("timed", name="timed.txt").copy(self.tm2)
+
+    def testDisabled(self):
+        instrumentation.ENABLED = False
+        self._attach_and_copy()
+        self.assertEqual(instrumentation.collector.dump(), {})
+
+    def testOperationsAreTimed(self):
+        instrumentation.ENABLED = True
+        connection.use_debug_cursor = True
+        try:
+            self._attach_and_copy()
+        finally:
+            connection.use_debug_cursor = None
+        stats = simplejson.loads(instrumentation.collector.dumps())
+
+        self.assertEqual(stats['storage.save']['count'], 1)
+        self.assertEqual(stats['attachment.copy']['count'], 1)
+        # The file's save, and the copy's.
+        self.assertEqual(stats['attachment.save']['count'], 2)
+        self.assertEqual(stats['attachment.slugify']['count'], 2)
+        self.assertTrue(stats['attachment.save']['queries'] > 0)
+        self.assertEqual(sum(count for bound, count
+                             in stats['attachment.save']['buckets']), 2)
+
+
+class TestInclusionTag(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        for i in range(50):
+            Attachment.objects.create_for_object(
+                self.tm, file="attachments/page-%s.png" % i,
+                title="Page %s" % i, attached_by=self.bob)
+        self.template = Template("{% load attachment_inclusion_tag %}"
+                                 "{% attachments object %}")
+
+    def _render(self, obj):
+        request = RequestFactory().get('/')
+        return self.template.render(Context(
+            {'object': obj, 'request': request, 'user': self.bob}))
+
+    def testRenderingTakesOneQuery(self):
+        ContentType.objects.get_for_model(self.tm)
+        tm = TestModel.objects.get(pk=self.tm.pk)
+        with self.assertNumQueries(1):
+            html = self._render(tm)
+        self.assertEqual(html.count("<tr  class="), 50)
+        pk = Attachment.objects.latest().pk
+        self.assertTrue("/attachments/%s/delete/" % pk in html)
+        self.assertTrue("/attachments/%s/derivatives/thumbnail/?v=" % pk
+                        in html)
+
+    def testPrefetchedAttachmentsAreReused(self):
+        tm = Attachment.objects.prefetch_attachments(
+            [TestModel.objects.get(pk=self.tm.pk)])[0]
+        with self.assertNumQueries(0):
+            self._render(tm)
+
+    def testAttachmentsAddedLaterAreListed(self):
+        tm = TestModel.objects.get(pk=self.tm.pk)
+        self.assertEqual(
+            len(Attachment.objects.attachment_list_for_object(tm)), 50)
+        Attachment.objects.create_for_object(
+            tm, file="attachments/page-50.png", title="Page 50",
+            attached_by=self.bob)
+        self.assertEqual(
+            len(Attachment.objects.attachment_list_for_object(tm)), 51)
+
+    def testCachedReverse(self):
+        for object_id in (1, 22):
+            self.assertEqual(
+                cached_reverse('attachment_new', content_type=3,
+                               object_id=object_id),
+                reverse('attachment_new', kwargs={'content_type': 3,
+                                                  'object_id': object_id}))
+
+
+class TestIntegrity(AttachmentTestCase):
+    def testHashedWhileStored(self):
+        attachment = self._attach("checksummed")
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.sha256,
+                         hashlib.sha256("checksummed").hexdigest())
+        self.assertEqual(attachment.size, len("checksummed"))
+
+    def testTemporaryUploadsAreHashed(self):
+        upload = TemporaryUploadedFile("big.bin", "application/octet-stream",
+                                       7, None)
+        upload.write("big one")
+        upload.seek(0)
+        attachment = self._attach(upload, name="big.bin")
+        self.assertEqual(attachment.sha256,
+                         hashlib.sha256("big one").hexdigest())
+        self.assertEqual(attachment.size, 7)
+
+    def testVerify(self):
+        intact = self._attach("intact")
+        changed = self._attach("changed")
+        missing = self._attach("missing")
+        self.storage.delete(changed.file.name)
+        self.storage.save(changed.file.name, ContentFile("chanGed"))
+        self.storage.delete(missing.file.name)
+
+        output = StringIO()
+        self.assertRaises(SystemExit, call_command, 'verify_attachments',
+                          workers=2, max_rate=100, stdout=output,
+                          stderr=StringIO())
+        lines = output.getvalue().splitlines()
+        self.assertTrue("MISSING %s %s" % (missing.pk, missing.file.name)
+                        in lines)
+        self.assertTrue(lines[0].startswith("MISMATCH %s " % changed.pk))
+        self.assertTrue(Attachment.objects.get(pk=intact.pk).verified)
+        self.assertFalse(Attachment.objects.get(pk=changed.pk).verified)
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.bob = User.objects.create(username="bob")
+        self.tm = TestModel.objects.create(name="Test1")
+        self.other = TestModel.objects.create(name="Test2")
+        for title, contents in (("Notes", "first"), ("Notes", "second")):
+            attachment = Attachment(content_object=self.tm,
+                                    attached_by=self.bob, title=title)
+            attachment.file.save("notes.txt", ContentFile(contents))
+        attachment = Attachment(content_object=self.other,
+                                attached_by=self.bob, title="Other")
+        attachment.file.save("other.txt", ContentFile("not exported"))
+        self.archive = NamedTemporaryFile(suffix='.tar.gz')
+
+    def tearDown(self):
+        self.archive.close()
+        for attachment in Attachment.objects.all():
+            attachment.file.delete(save=False)
+
+    def testExportAndImport(self):
+        call_command('export_attachments', 'attachments.testmodel',
+                     pks=str(self.tm.pk), output=self.archive.name,
+                     stderr=StringIO())
+        exported = dict((a.slug, (a.file.name, a.sha256)) for a in
+                        Attachment.objects.attachments_for_object(self.tm))
+        for attachment in Attachment.objects.attachments_for_object(self.tm):
+            attachment.delete()
+        flush_after_commit()
+
+        output = StringIO()
+        call_command('import_attachments', self.archive.name, workers=2,
+                     stdout=output)
+        self.assertTrue(output.getvalue().startswith("Imported 2 "))
+        imported = Attachment.objects.attachments_for_object(self.tm)
+        self.assertEqual(
+            dict((a.slug, (a.file.name, a.sha256)) for a in imported),
+            exported)
+        self.assertEqual(sorted(a.file.read() for a in imported),
+                         ["first", "second"])
+        self.assertEqual(
+            AttachmentCount.objects.get(object_id=self.tm.pk).count, 2)
+
+    def testSkipMissingKeepsObjectsHiddenByTheDefaultManager(self):
+        with hidden_test_models():
+            call_command('export_attachments', 'attachments.testmodel',
+                         pks=str(self.tm.pk), output=self.archive.name,
+                         stderr=StringIO())
+            output = StringIO()
+            call_command('import_attachments', self.archive.name,
+                         skip_missing=True, stdout=output)
+        self.assertTrue(output.getvalue().startswith(
+            "Imported 2 attachments, skipped 0"))
+
+    def testJsonFilesAreNotMistakenForMetadata(self):
+        attachment = Attachment(content_object=self.tm, attached_by=self.bob,
+                                title="Data")
+        attachment.file.save("data.json", ContentFile('{"rows": []}'))
+        call_command('export_attachments', 'attachments.testmodel',
+                     pks=str(self.tm.pk), output=self.archive.name,
+                     stderr=StringIO())
+        for attachment in Attachment.objects.attachments_for_object(self.tm):
+            attachment.delete()
+        flush_after_commit()
+
+        call_command('import_attachments', self.archive.name, workers=2,
+                     stdout=StringIO())
+        imported = Attachment.objects.get(slug="data")
+        self.assertEqual(imported.file_name(), "data.json")
+        self.assertEqual(imported.file.read(), '{"rows": []}')
+        self.assertEqual(
+            Attachment.objects.attachments_for_object(self.tm).count(), 3)
+
+    def testImportKeepsExistingSlugs(self):
+        call_command('export_attachments', 'attachments.testmodel',
+                     pks=str(self.tm.pk), output=self.archive.name,
+                     stderr=StringIO())
+        call_command('import_attachments', self.archive.name, workers=2,
+                     stdout=StringIO())
+        self.assertEqual(
+            sorted(Attachment.objects.attachments_for_object(self.tm)
+                   .values_list('slug', flat=True)),
+            ['notes', 'notes-2', 'notes-3', 'notes-4'])
@@ -3,17 +3,35 @@ from django.contrib import admin
 
 admin.autodiscover()
 
-urlpatterns = patterns('attachment.views',
+urlpatterns = patterns('attachments.views',
     url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/$',
         'list_attachments',
         name='attachment_list'),
+    url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/json/$',
+        'list_attachments_json',
+        name='attachment_list_json'),
     url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/new/$',
         'new_attachment',
         name='attachment_new'),
+    url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/new/many/$',
+        'new_attachments',
+        name='attachment_new_many'),
+    url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/upload/$',
+        'start_chunked_upload',
+        name='attachment_upload_start'),
+    url(r'^upload/(?P<upload_id>[0-9a-f]{32})/$',
+        'chunked_upload',
+        name='attachment_upload_chunk'),
     url(r'^(?P<attachment_id>\d+)/edit/$',
         'edit_attachment',
         name='attachment_edit'),
     url(r'^(?P<attachment_id>\d+)/delete/$',
         'delete_attachment',
         name='attachment_delete'),
+    url(r'^(?P<attachment_id>\d+)/download/$',
+        'download_attachment',
+        name='attachment_download'),
+    url(r'^(?P<attachment_id>\d+)/derivatives/(?P<name>[\w-]+)/$',
+        'download_derivative',
+        name='attachment_derivative'),
 )
\ No newline at end of file
@@ -1,6 +1,28 @@
+from __future__ import with_statement
+
 from django.template.defaultfilters import slugify
+from django.db import connection, transaction
+from django.db.models import Q
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse, NoReverseMatch, get_urlconf, \
+    get_script_prefix
+from django.utils.http import urlquote
 
+import Queue
+import itertools
+import logging
 import re
+import sys
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('attachments')
+
+# The largest numeric suffix ``unique_slugify`` expects to append.
+MAX_SLUG_SUFFIX = 10 ** 9
+
+# How many slug prefixes ``unique_slugs`` looks up per query.
+SLUG_PREFIXES_PER_QUERY = 200
 
 def unique_slugify(instance, value, slug_field_name='slug', queryset=None,
                    slug_separator='-'):
@@ -22,31 +44,92 @@ def unique_slugify(instance, value, slug_field_name='slug', queryset=None,
     slug_len = slug_field.max_length
 
     # Sort out the initial slug. Chop its length down if we need to.
-    slug = slugify(value)
-    if slug_len:
-        slug = slug[:slug_len]
-    slug = _slug_strip(slug, slug_separator)
-    original_slug = slug
+    original_slug = _initial_slug(value, slug_len, slug_separator)
 
     # Create a queryset, excluding the current instance.
-    if not queryset:
+    if queryset is None:
         queryset = instance.__class__._default_manager.all()
         if instance.pk:
             queryset = queryset.exclude(pk=instance.pk)
 
-    # Find a unique slug. If one matches, at '-2' to the end and try again
-    # (then '-3', etc).
+    # Fetch every slug that could collide in a single query, then find the
+    # first free one in memory.
+    prefix = _collision_prefix(original_slug, slug_len, slug_separator)
+    taken = set(queryset.filter(**{
+        '%s__startswith' % slug_field_name: prefix
+    }).values_list(slug_field_name, flat=True))
+    slug = next_free_slug(original_slug, taken, slug_len, slug_separator)
+
+    setattr(instance, slug_field.attname, slug)
+
+def unique_slugs(model, values, queryset=None, slug_field_name='slug',
+                 slug_separator='-'):
+    """
+    Like ``unique_slugify``, but calculates the slugs for several new
+    instances of ``model`` at once, returning them in the order of
+    ``values``. The slugs are unique amongst each other too.
+
+    The taken slugs are fetched in a single query per
+    ``SLUG_PREFIXES_PER_QUERY`` distinct values.
+    """
+    slug_field = model._meta.get_field(slug_field_name)
+    slug_len = slug_field.max_length
+    if queryset is None:
+        queryset = model._default_manager.all()
+
+    originals = [_initial_slug(value, slug_len, slug_separator)
+                 for value in values]
+    prefixes = list(set(_collision_prefix(slug, slug_len, slug_separator)
+                        for slug in originals))
+    taken = set()
+    for i in range(0, len(prefixes), SLUG_PREFIXES_PER_QUERY):
+        query = Q()
+        for prefix in prefixes[i:i + SLUG_PREFIXES_PER_QUERY]:
+            query |= Q(**{'%s__startswith' % slug_field_name: prefix})
+        taken.update(queryset.filter(query).values_list(slug_field_name,
+                                                        flat=True))
+
+    slugs = []
+    for slug in originals:
+        slug = next_free_slug(slug, taken, slug_len, slug_separator)
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
+def _initial_slug(value, slug_len=None, slug_separator='-'):
+    slug = slugify(value)
+    if slug_len:
+        slug = slug[:slug_len]
+    return _slug_strip(slug, slug_separator)
+
+def _collision_prefix(slug, slug_len=None, slug_separator='-'):
+    """
+    What every slug that ``next_free_slug`` might try for ``slug`` ('slug',
+    'slug-2', 'slug-3', ...) starts with: the stem left over for the longest
+    suffix it would use.
+    """
+    return _slug_with_suffix(slug, MAX_SLUG_SUFFIX, slug_len,
+                             slug_separator)[:-len('-%s' % MAX_SLUG_SUFFIX)]
+
+def next_free_slug(slug, taken, slug_len=None, slug_separator='-'):
+    """
+    Returns ``slug`` if it is not empty and not in ``taken``. Otherwise tries
+    ``slug-2``, ``slug-3``, etc. (shortened to fit ``slug_len``) until a free
+    one is found.
+    """
+    candidate = slug
     next = 2
-    while not slug or queryset.filter(**{slug_field_name: slug}):
-        slug = original_slug
-        end = '-%s' % next
-        if slug_len and len(slug) + len(end) > slug_len:
-            slug = slug[:slug_len-len(end)]
-            slug = _slug_strip(slug, slug_separator)
-        slug = '%s%s' % (slug, end)
+    while not candidate or candidate in taken:
+        candidate = _slug_with_suffix(slug, next, slug_len, slug_separator)
         next += 1
+    return candidate
 
-    setattr(instance, slug_field.attname, slug)
+def _slug_with_suffix(slug, number, slug_len=None, slug_separator='-'):
+    end = '-%s' % number
+    if slug_len and len(slug) + len(end) > slug_len:
+        slug = slug[:slug_len-len(end)]
+        slug = _slug_strip(slug, slug_separator)
+    return '%s%s' % (slug, end)
 
 def _slug_strip(value, separator=None):
     """
@@ -80,4 +163,179 @@ def get_callable_from_string(path):
     except AttributeError:
         raise ImproperlyConfigured, 'Module "%s" does not define a "%s" callable' % (module, attr)
 
-    return func
\ No newline at end of file
+    return func
+
+def map_in_threads(func, items, threads):
+    """
+    Calls ``func`` for every item in ``items`` using ``threads`` threads and
+    returns the results in order. With fewer than two threads or items it
+    simply runs in the current thread. If any call fails, the first
+    exception is raised once every item has been tried.
+    """
+    items = list(items)
+    if threads < 2 or len(items) < 2:
+        return map(func, items)
+
+    todo = Queue.Queue()
+    for i, item in enumerate(items):
+        todo.put((i, item))
+    results = [None] * len(items)
+    errors = []
+
+    def work():
+        try:
+            while True:
+                try:
+                    i, item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception:
+                    errors.append((i, sys.exc_info()))
+        finally:
+            # Database connections are per thread; don't leak any opened here.
+            connection.close()
+
+    workers = [threading.Thread(target=work)
+               for i in range(min(threads, len(items)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        exc_type, exc_value, tb = min(errors)[1]
+        raise exc_type, exc_value, tb
+    return results
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that forgets the least recently used entry
+    once it holds more than ``size`` of them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # Maps keys to [value, when it was last used].
+        self.data = {}
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                entry = self.data[key]
+                entry[1] = self.clock.next()
+                return entry[0]
+        finally:
+            self.lock.release()
+        value = compute()
+        self.lock.acquire()
+        try:
+            self.data[key] = [value, self.clock.next()]
+            while len(self.data) > self.size:
+                # Caches are small and this only happens on a miss, so a
+                # scan is cheap enough.
+                oldest = min(self.data, key=lambda k: self.data[k][1])
+                del self.data[oldest]
+        finally:
+            self.lock.release()
+        return value
+
+# Stand-ins for the arguments of cached_reverse; numbers, so that they match
+# the usual URL patterns.
+_REVERSE_PLACEHOLDER = 987654321000
+
+_reverse_cache = {}
+
+def cached_reverse(viewname, **kwargs):
+    """
+    Like ``reverse(viewname, kwargs=kwargs)``, but only resolves the URL once
+    for every set of keyword argument names; later calls just fill in the
+    values. Only for URL patterns taking every argument as is, like
+    ``(?P<object_id>\d+)``.
+    """
+    names = tuple(sorted(kwargs))
+    key = (viewname, names, get_urlconf(), get_script_prefix())
+    template = _reverse_cache.get(key)
+    if template is None:
+        placeholders = dict((name, _REVERSE_PLACEHOLDER + i)
+                            for i, name in enumerate(names))
+        try:
+            url = reverse(viewname, kwargs=placeholders)
+        except NoReverseMatch:
+            # The pattern doesn't accept the placeholders.
+            return reverse(viewname, kwargs=kwargs)
+        template = url.replace('%', '%%')
+        for name, placeholder in placeholders.items():
+            template = template.replace(str(placeholder), '%%(%s)s' % name)
+        _reverse_cache[key] = template
+    return template % dict((name, urlquote(value))
+                           for name, value in kwargs.items())
+
+@contextmanager
+def commit_on_success_unless_managed(using=None):
+    """
+    Runs the block in a transaction of its own, unless a transaction is
+    already being managed; nesting commit_on_success would commit that one
+    early.
+
+    Functions passed to ``run_after_commit`` in the block run once the
+    transaction of its own has been committed.
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        try:
+            with transaction.commit_on_success(using=using):
+                yield
+        except:
+            discard_after_commit()
+            raise
+        flush_after_commit()
+
+_after_commit = threading.local()
+
+def run_after_commit(func):
+    """
+    Calls ``func`` once the current transaction has been committed, or right
+    away if no transaction is being managed.
+
+    Django has no hook for commits, so ``func`` is kept until the
+    outermost ``commit_on_success_unless_managed`` block commits, or, for
+    transactions managed elsewhere (eg. by ``TransactionMiddleware``), until
+    the request finishes. It is dropped if the block or the request fails.
+    Code managing transactions itself outside of requests should call
+    ``flush_after_commit`` after committing.
+    """
+    if transaction.is_managed():
+        _after_commit.__dict__.setdefault('funcs', []).append(func)
+    else:
+        _call_logging_errors(func)
+
+def flush_after_commit(**kwargs):
+    """
+    Calls the functions waiting for a commit, including any they schedule
+    themselves. Also a ``request_finished`` signal handler.
+    """
+    while True:
+        funcs = _after_commit.__dict__.pop('funcs', [])
+        if not funcs:
+            break
+        for func in funcs:
+            _call_logging_errors(func)
+
+def discard_after_commit(**kwargs):
+    """
+    Forgets the functions waiting for a commit that won't happen. Also a
+    ``got_request_exception`` signal handler.
+    """
+    _after_commit.__dict__.pop('funcs', None)
+
+def _call_logging_errors(func):
+    # The transaction is already over, so there's nobody to tell but the log.
+    try:
+        func()
+    except Exception:
+        logger.exception("Running %r after commit failed", func)
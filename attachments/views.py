@@ -1,16 +1,34 @@
+import hashlib
+import re
+from datetime import datetime
+
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.http import HttpResponseRedirect, Http404, HttpResponse, \
+    HttpResponseNotAllowed, HttpResponseNotModified, HttpResponseBadRequest
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
-from django.core import serializers
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
 from django.utils import simplejson
 
-from attachments.models import Attachment
-from attachments.forms import AttachmentForm, AttachmentEditForm
+from attachments.models import Attachment, ChunkedUpload, ChunkedUploadError
+from attachments.forms import AttachmentForm, AttachmentEditForm, \
+    ChunkedUploadForm, MultipleAttachmentForm
+from attachments.derivatives import DerivativeError, get_derivative
+from attachments.downloads import serve_attachment, serve_derivative
+from attachments.instrumentation import instrumented
+from attachments.middleware import get_accept
+from attachments.processing import process_later
+from attachments.utils import run_after_commit
 
+JSON_PAGE_SIZE = getattr(settings, 'ATTACHMENT_JSON_PAGE_SIZE', 50)
+JSON_MAX_PAGE_SIZE = getattr(settings, 'ATTACHMENT_JSON_MAX_PAGE_SIZE', 500)
 
 @login_required
+@instrumented('views.new_attachment')
 def new_attachment(request, content_type, object_id,
                    template_name='attachments/new_attachment.html',
                    form_cls=AttachmentForm,
@@ -27,6 +45,8 @@ def new_attachment(request, content_type, object_id,
                                               commit=False)
             attachment.attached_by = request.user
             attachment.save()
+            # A processing thread must not look for it before it's committed.
+            run_after_commit(lambda: process_later(attachment))
             if callable(redirect):
                 return HttpResponseRedirect(redirect(object, attachment))
             else:
@@ -40,6 +60,56 @@ def new_attachment(request, content_type, object_id,
     }, context_instance=RequestContext(request))
 
 @login_required
+@instrumented('views.new_attachments')
+def new_attachments(request, content_type, object_id,
+                    template_name='attachments/new_attachments.html',
+                    form_cls=MultipleAttachmentForm):
+    """
+    Attaches several files in one request. Answers with a summary of what
+    became of each file, as JSON if the client prefers it.
+    """
+    object_type = get_object_or_404(ContentType, id = int(content_type))
+    try:
+        object = object_type.get_object_for_this_type(pk=int(object_id))
+    except object_type.DoesNotExist:
+        raise Http404
+    results = None
+    if request.method == "POST":
+        attachment_form = form_cls(request.POST, request.FILES)
+        if attachment_form.is_valid():
+            results = attachment_form.save(object, request.user)
+            for result in results:
+                if 'attachment' in result:
+                    run_after_commit(
+                        lambda a=result['attachment']: process_later(a))
+            media_type = get_accept(request).best_match(
+                ['text/html', 'application/json'], default='text/html')
+            if media_type == 'application/json':
+                return _json_response({'files': [
+                    _upload_result(result) for result in results]})
+            attachment_form = form_cls()
+    else:
+        attachment_form = form_cls()
+
+    return render_to_response(template_name, {
+        "form": attachment_form,
+        "object": object,
+        "results": results,
+    }, context_instance=RequestContext(request))
+
+def _upload_result(result):
+    data = {'name': result['name']}
+    if 'attachment' in result:
+        attachment = result['attachment']
+        data.update(id=attachment.pk, title=attachment.title,
+                    slug=attachment.slug, size=attachment.size,
+                    file_url=attachment.file_url())
+    else:
+        data['error'] = result['error']
+    return data
+
+@login_required
+@instrumented('views.edit_attachment')
 def edit_attachment(request, attachment_id,
                    template_name='attachments/edit_attachment.html',
                    form_cls=AttachmentEditForm,
@@ -65,6 +135,7 @@ def edit_attachment(request, attachment_id,
     }, context_instance=RequestContext(request))
 
 @login_required
+@instrumented('views.delete_attachment')
 def delete_attachment(request, attachment_id, redirect=None):
     attachment = get_object_or_404(Attachment, pk=attachment_id)
     object_type = attachment.content_type
@@ -82,6 +153,7 @@ def delete_attachment(request, attachment_id, redirect=None):
         return HttpResponse(content, content_type='application/json')
 
 @login_required
+@instrumented('views.list_attachments')
 def list_attachments(request, content_type, object_id,
                    template_name='attachments/list_attachments.html'):
     object_type = get_object_or_404(ContentType, id = int(content_type))
@@ -90,15 +162,200 @@ def list_attachments(request, content_type, object_id,
     except object_type.DoesNotExist:
         raise Http404
 
-    attachments = Attachment.objects.attachments_for_object(object)
-    for media_type in request.accepted_types:
-        if media_type == 'application/json':
-            data = serializers.serialize('json', attachments)
-            return HttpResponse(data, mimetype='application/json')
-        else:
-            return render_to_response(template_name, {
-                'attachments': attachments,
-                'object': object
-            }, context_instance=RequestContext(request))
+    media_type = get_accept(request).best_match(
+        ['text/html', 'application/json'], default='text/html')
+    if media_type == 'application/json':
+        return _attachments_json(request, object_type, object.pk)
+    else:
+        attachments = Attachment.objects.attachment_list_for_object(object)
+        return render_to_response(template_name, {
+            'attachments': attachments,
+            'object': object
+        }, context_instance=RequestContext(request))
+
+@login_required
+@instrumented('views.list_attachments_json')
+def list_attachments_json(request, content_type, object_id):
+    """
+    The attachments of an object as JSON, newest first, in pages of
+    ``limit`` (default ``ATTACHMENT_JSON_PAGE_SIZE``). Pass the ``next``
+    value of a page as ``after`` to get the following one.
+    """
+    try:
+        object_type = ContentType.objects.get_for_id(int(content_type))
+    except ContentType.DoesNotExist:
+        raise Http404
+    model = object_type.model_class()
+    if model is None or \
+            not model._default_manager.filter(pk=int(object_id)).exists():
+        raise Http404
+    return _attachments_json(request, object_type, int(object_id))
+
+def _parse_json_cursor(value):
+    timestamp, pk = value.rsplit(',', 1)
+    # isoformat() leaves out the microseconds when there are none, and
+    # strptime only knows %f from Python 2.6, so they are parsed by hand.
+    timestamp, dot, microseconds = timestamp.partition('.')
+    if dot and not (microseconds.isdigit() and len(microseconds) <= 6):
+        raise ValueError("Invalid timestamp %r" % value)
+    timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+    if microseconds:
+        timestamp = timestamp.replace(
+            microsecond=int(microseconds.ljust(6, '0')))
+    return timestamp, int(pk)
+
+def _attachments_json(request, object_type, object_id):
+    """
+    Builds the JSON listing straight from ``values()`` rows, paginated on
+    ``(attached_timestamp, id)``, so that pages stay stable as attachments
+    are added. Answers with 304 if the client's ``If-None-Match`` matches.
+    """
+    try:
+        limit = max(1, min(int(request.GET.get('limit', JSON_PAGE_SIZE)),
+                           JSON_MAX_PAGE_SIZE))
+    except ValueError:
+        limit = JSON_PAGE_SIZE
+
+    rows = Attachment.objects.filter(
+        content_type=object_type, object_id=object_id,
+    ).order_by('-attached_timestamp', '-id').values(
+        'id', 'title', 'slug', 'summary', 'file', 'size',
+        'attached_timestamp', 'attached_by__username')
+    if request.GET.get('after'):
+        try:
+            timestamp, pk = _parse_json_cursor(request.GET['after'])
+        except ValueError:
+            return HttpResponseBadRequest("Invalid 'after' cursor")
+        rows = rows.filter(Q(attached_timestamp__lt=timestamp) |
+                           Q(attached_timestamp=timestamp, id__lt=pk))
 
+    rows = list(rows[:limit + 1])
+    next = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next = '%s,%s' % (rows[-1]['attached_timestamp'].isoformat(),
+                          rows[-1]['id'])
+
+    storage = Attachment._meta.get_field('file').storage
+    for row in rows:
+        row['file_url'] = row['file'] and storage.url(row['file']) or None
+        row['attached_by'] = row.pop('attached_by__username')
+
+    content = simplejson.dumps({'attachments': rows, 'next': next},
+                               cls=DjangoJSONEncoder, ensure_ascii=False)
+    etag = '"%s"' % hashlib.md5(content.encode('utf-8')).hexdigest()
+    if etag in [e.strip() for e in
+                request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+@login_required
+@instrumented('views.download_attachment')
+def download_attachment(request, attachment_id, as_attachment=True):
+    attachment = get_object_or_404(Attachment, pk=attachment_id)
+    if not attachment.file:
+        raise Http404
+    return serve_attachment(request, attachment, as_attachment=as_attachment)
+
+@login_required
+@instrumented('views.download_derivative')
+def download_derivative(request, attachment_id, name):
+    attachment = get_object_or_404(Attachment, pk=attachment_id)
+    if not attachment.file:
+        raise Http404
+    try:
+        derivative = get_derivative(attachment, name)
+    except DerivativeError:
+        raise Http404
+    return serve_derivative(request, derivative)
+
+content_range_re = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+def _json_response(data, status=200):
+    content = simplejson.dumps(data, ensure_ascii=False)
+    return HttpResponse(content, content_type='application/json',
+                        status=status)
+
+def _upload_status(upload, status=200):
+    response = _json_response({
+        'upload_id': upload.upload_id,
+        'offset': upload.offset,
+        'size': upload.size,
+        'complete': upload.complete,
+    }, status=status)
+    if upload.offset:
+        response['Range'] = 'bytes=0-%s' % (upload.offset - 1)
+    return response
+
+@login_required
+@instrumented('views.start_chunked_upload')
+def start_chunked_upload(request, content_type, object_id,
+                         form_cls=ChunkedUploadForm):
+    """
+    Starts a chunked upload for the given object. POST ``filename``, ``size``
+    and optionally ``title`` and ``summary``; the ``upload_id`` in the
+    response identifies the upload for ``chunked_upload``.
+    """
+    object_type = get_object_or_404(ContentType, id = int(content_type))
+    try:
+        object = object_type.get_object_for_this_type(pk=int(object_id))
+    except object_type.DoesNotExist:
+        raise Http404
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+
+    upload_form = form_cls(request.POST)
+    if not upload_form.is_valid():
+        return _json_response({'errors': upload_form.errors}, status=400)
+    upload = upload_form.save(content_object=object, user=request.user)
+    return _upload_status(upload, status=201)
+
+@login_required
+@transaction.commit_on_success
+@instrumented('views.chunked_upload')
+def chunked_upload(request, upload_id):
+    """
+    Receives the chunks of an upload started with ``start_chunked_upload``.
+
+    PUT (or POST) the raw bytes with a ``Content-Range: bytes
+    <first>-<last>/<size>`` header, and optionally ``Content-MD5``. Chunks
+    must arrive in order; GET returns the current offset to resume from and
+    DELETE abandons the upload. The attachment is created as soon as the
+    last chunk has been received.
+    """
+    upload = get_object_or_404(ChunkedUpload.objects.select_for_update(),
+                               upload_id=upload_id, user=request.user)
+    if request.method in ("GET", "HEAD"):
+        return _upload_status(upload)
+    if request.method == "DELETE":
+        upload.abort()
+        return _json_response({'success': True})
+    if request.method not in ("PUT", "POST"):
+        return HttpResponseNotAllowed(['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
+
+    match = content_range_re.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+    if not match:
+        return _json_response({'error': 'Missing or invalid Content-Range'},
+                              status=400)
+    start, end, size = [int(value) for value in match.groups()]
+    if size != upload.size or end < start:
+        return _json_response({'error': 'Invalid Content-Range'}, status=400)
+
+    try:
+        upload.append(request, start, end - start + 1,
+                      md5=request.META.get('HTTP_CONTENT_MD5'))
+    except ChunkedUploadError:
+        # Tell the client where to resume from.
+        return _upload_status(upload, status=409)
 
+    if upload.complete:
+        attachment = upload.finish()
+        run_after_commit(lambda: process_later(attachment))
+        return _json_response({
+            'complete': True,
+            'attachment_id': attachment.pk,
+        }, status=201)
+    return _upload_status(upload)
@@ -0,0 +1,141 @@
+"""
+Compares the query plans and timings of the attachment listing query with and
+without the (content_type_id, object_id, attached_timestamp) index, on a large
+SQLite table::
+
+    python benchmarks/query_plans.py --rows 10000000 --per-object 10
+
+The database is built in a temporary file unless ``--database`` is given; an
+existing database is reused as it is, which saves filling a big table again.
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+parser = OptionParser(usage="%prog [options]")
+parser.add_option('--rows', type='int', default=10000000,
+                  help="number of attachments to create")
+parser.add_option('--per-object', type='int', default=10,
+                  help="attachments per content object")
+parser.add_option('--database', help="SQLite database file to use")
+parser.add_option('--repeat', type='int', default=1000,
+                  help="listing queries to time per variant")
+
+
+def setup(database):
+    from django.conf import settings
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': database}},
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes',
+                        'attachments'],
+        MEDIA_ROOT=tempfile.mkdtemp(),
+    )
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def fill(rows, per_object):
+    """
+    Inserts ``rows`` attachments with plain ``executemany`` calls, which is
+    a lot faster than saving models one by one.
+    """
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection, transaction
+    from attachments.models import Attachment, TestModel
+
+    if Attachment.objects.exists():
+        return
+    user = User.objects.create(username='benchmark')
+    content_type = ContentType.objects.get_for_model(TestModel)
+    fields = [f for f in Attachment._meta.local_fields if f.column != 'id']
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        Attachment._meta.db_table, ', '.join(f.column for f in fields),
+        ', '.join(['%s'] * len(fields)))
+
+    cursor = connection.cursor()
+    start = datetime(2000, 1, 1)
+    batch = []
+    for i in xrange(rows):
+        attachment = Attachment(
+            content_type=content_type, object_id=i // per_object,
+            attached_by=user, title='File %s' % i, slug='file-%s' % i,
+            summary='A summary that is never shown in listings. ' * 10,
+            attached_timestamp=start + timedelta(seconds=i),
+            file='attachments/file-%s.pdf' % i)
+        batch.append([f.get_db_prep_save(f.pre_save(attachment, True),
+                                         connection=connection)
+                      for f in fields])
+        if len(batch) == 10000:
+            cursor.executemany(sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+    transaction.commit_unless_managed()
+
+
+def index_sql():
+    import attachments
+    path = os.path.join(os.path.dirname(attachments.__file__), 'sql',
+                        'attachment.sql')
+    return '\n'.join(line for line in open(path).read().splitlines()
+                     if not line.startswith('--'))
+
+
+def explain(queryset):
+    from django.db import connection
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def timed(get_queryset, repeat, objects):
+    started = time.time()
+    for i in xrange(repeat):
+        list(get_queryset(objects[i % len(objects)]))
+    return (time.time() - started) / repeat * 1000
+
+
+def main():
+    options, args = parser.parse_args()
+    database = options.database or tempfile.mktemp(suffix='.sqlite3')
+    setup(database)
+    fill(options.rows, options.per_object)
+
+    from django.db import connection
+    from attachments.models import Attachment, TestModel
+
+    objects = [TestModel(pk=i) for i in
+               xrange(0, options.rows // options.per_object, 997)]
+    variants = [
+        ('attachments_for_object',
+         Attachment.objects.attachments_for_object),
+    ]
+    cursor = connection.cursor()
+    for indexed in (False, True):
+        if indexed:
+            cursor.execute(index_sql())
+        else:
+            cursor.execute('DROP INDEX IF EXISTS '
+                           'attachments_attachment_object_timestamp')
+        print '%s composite index:' % (indexed and 'With' or 'Without')
+        for name, get_queryset in variants:
+            print '  %s: %.3f ms/query' % (
+                name, timed(get_queryset, options.repeat, objects))
+            for line in explain(get_queryset(objects[0])):
+                print '    ' + line
+
+    if not options.database:
+        os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
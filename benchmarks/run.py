@@ -0,0 +1,304 @@
+"""
+Times the hot paths of django-attachments against SQLite and a local file
+storage, and writes the results as JSON so that releases can be compared::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --only listing,slugs --sizes 1,100
+
+Each benchmark is run ``--repeat`` times; the results give the fastest and
+the median run and how many queries one run made. Everything is created in
+a temporary directory that is removed afterwards.
+"""
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+parser = OptionParser(usage="%prog [options]")
+parser.add_option('--output', help="file to write the JSON results to "
+                                   "(default: standard output)")
+parser.add_option('--sizes', default='1,100,10000',
+                  help="attachments per object for the listing benchmarks")
+parser.add_option('--repeat', type='int', default=5,
+                  help="runs per benchmark")
+parser.add_option('--only', help="comma separated benchmarks to run, out of "
+                                 "listing, template, slugs, copy, usage and "
+                                 "transfer")
+parser.add_option('--collisions', type='int', default=1000,
+                  help="existing attachments with the same title for the "
+                       "slug benchmarks")
+parser.add_option('--copies', type='int', default=100,
+                  help="attachments to copy in the copy benchmarks")
+parser.add_option('--file-size', type='int', default=1024 * 1024,
+                  help="bytes per file in the transfer benchmarks")
+parser.add_option('--files', type='int', default=20,
+                  help="files to upload and download in the transfer "
+                       "benchmarks")
+
+
+def setup(directory):
+    from django.conf import settings
+    settings.configure(
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'benchmark.sqlite3')}},
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes',
+                        'attachments'],
+        MEDIA_ROOT=os.path.join(directory, 'media'),
+        ATTACHMENT_PROCESSING=None,
+    )
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+class Context(object):
+    """
+    Objects shared by the benchmarks.
+    """
+
+    def __init__(self, options):
+        from django.contrib.auth.models import User
+        from django.contrib.contenttypes.models import ContentType
+        from attachments.models import TestModel
+        self.options = options
+        self.user = User.objects.create(username='benchmark')
+        self.content_type = ContentType.objects.get_for_model(TestModel)
+
+    def new_object(self):
+        from attachments.models import TestModel
+        return TestModel.objects.create(name='benchmark')
+
+    def insert(self, objects, per_object, title='File'):
+        """
+        Inserts ``per_object`` attachments (without files) for each of
+        ``objects`` with plain ``executemany`` calls, which is a lot faster
+        than saving models one by one.
+        """
+        from django.db import connection, transaction
+        from attachments.models import Attachment
+
+        fields = [f for f in Attachment._meta.local_fields
+                  if f.column != 'id']
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            Attachment._meta.db_table, ', '.join(f.column for f in fields),
+            ', '.join(['%s'] * len(fields)))
+        cursor = connection.cursor()
+        start = datetime(2000, 1, 1)
+        batch = []
+        for obj in objects:
+            for i in xrange(per_object):
+                attachment = Attachment(
+                    content_type=self.content_type, object_id=obj.pk,
+                    attached_by=self.user, title='%s %s' % (title, i),
+                    slug='%s-%s' % (title.lower(), i), size=1024,
+                    attached_timestamp=start + timedelta(seconds=i),
+                    file='attachments/%s-%s.pdf' % (obj.pk, i))
+                batch.append([
+                    f.get_db_prep_save(f.pre_save(attachment, True),
+                                       connection=connection)
+                    for f in fields])
+                if len(batch) == 5000:
+                    cursor.executemany(sql, batch)
+                    batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+        transaction.commit_unless_managed()
+
+    def attach_files(self, obj, count, size):
+        from django.core.files.base import ContentFile
+        from attachments.models import Attachment
+        attachments = []
+        for i in xrange(count):
+            attachment = Attachment(content_object=obj, attached_by=self.user,
+                                    title='Scan %s' % i)
+            attachment.file.save('scan.bin', ContentFile('x' * size))
+            attachments.append(attachment)
+        return attachments
+
+
+def measure(func, repeat, prepare=None):
+    """
+    Runs ``func`` ``repeat`` times, calling ``prepare`` before each run to
+    get its arguments without timing that.
+    """
+    from django.db import connection
+    times = []
+    for i in xrange(repeat):
+        args = prepare and prepare() or ()
+        connection.queries = []
+        started = time.time()
+        func(*args)
+        times.append(time.time() - started)
+    times.sort()
+    return {
+        'min_seconds': times[0],
+        'median_seconds': times[len(times) // 2],
+        'queries': len(connection.queries),
+    }
+
+
+def bench_listing(context):
+    from attachments.models import Attachment
+    for size in context.options.sizes:
+        obj = context.new_object()
+        context.insert([obj], size)
+        yield 'attachments_for_object', {'attachments': size}, measure(
+            lambda: list(Attachment.objects.attachments_for_object(obj)),
+            context.options.repeat)
+
+
+def bench_template(context):
+    from django.template import Context as TemplateContext, Template
+    template = Template(
+        '{% load attachment_tags %}'
+        '{% get_attachments for object as attachments %}'
+        '{% for attachment in attachments %}'
+        '<a href="{{ attachment.file_url }}">{{ attachment.title }}</a> '
+        '{{ attachment.attached_by }} {{ attachment.attached_timestamp }}'
+        '{% endfor %}')
+    for size in context.options.sizes:
+        obj = context.new_object()
+        context.insert([obj], size)
+        yield 'get_attachments_tag', {'attachments': size}, measure(
+            lambda: template.render(TemplateContext({'object': obj})),
+            context.options.repeat)
+
+
+def bench_slugs(context):
+    from attachments.models import Attachment
+    from attachments.utils import unique_slugify, unique_slugs
+    collisions = context.options.collisions
+    obj = context.new_object()
+    context.insert([obj], collisions, title='Scan')
+    # insert() numbers the titles; make them all collide.
+    Attachment.objects.filter(object_id=obj.pk).update(title='Scan')
+    queryset = Attachment.objects.attachments_for_object(obj)
+
+    attachment = Attachment(content_object=obj)
+    yield 'unique_slugify', {'collisions': collisions}, measure(
+        lambda: unique_slugify(attachment, 'Scan', queryset=queryset),
+        context.options.repeat)
+    yield 'unique_slugs', {'collisions': collisions, 'slugs': 100}, measure(
+        lambda: unique_slugs(Attachment, ['Scan'] * 100, queryset=queryset),
+        context.options.repeat)
+
+
+def bench_copy(context):
+    from attachments.models import Attachment
+    count = context.options.copies
+    source = context.new_object()
+    context.attach_files(source, count, 1024)
+    for deepcopy in (False, True):
+        yield 'copy_attachments', {'attachments': count,
+                                   'deepcopy': deepcopy}, measure(
+            lambda target: Attachment.objects.copy_attachments(
+                source, target, deepcopy=deepcopy),
+            context.options.repeat, lambda: (context.new_object(),))
+
+
+def bench_usage(context):
+    from attachments.models import Attachment, TestModel
+    objects = [context.new_object() for i in xrange(1000)]
+    context.insert(objects, 10)
+    queryset = TestModel.objects.filter(pk__in=[o.pk for o in objects])
+    for counts in (False, True):
+        yield 'usage_for_queryset', {'objects': len(objects),
+                                     'attachments': len(objects) * 10,
+                                     'counts': counts}, measure(
+            lambda: list(Attachment.objects.usage_for_queryset(
+                queryset, counts=counts).iterator()),
+            context.options.repeat)
+
+
+def bench_transfer(context):
+    from django.test.client import RequestFactory
+    from attachments.downloads import serve_attachment
+    options = context.options
+    megabytes = options.files * options.file_size / (1024.0 * 1024)
+    params = {'files': options.files, 'file_size': options.file_size}
+
+    obj = context.new_object()
+    result = measure(
+        lambda: context.attach_files(obj, options.files, options.file_size),
+        options.repeat)
+    result['mb_per_second'] = megabytes / result['median_seconds']
+    yield 'upload', params, result
+
+    attachments = context.attach_files(obj, options.files, options.file_size)
+    request = RequestFactory().get('/')
+    def download():
+        for attachment in attachments:
+            for chunk in serve_attachment(request, attachment):
+                pass
+    result = measure(download, options.repeat)
+    result['mb_per_second'] = megabytes / result['median_seconds']
+    yield 'download', params, result
+
+
+BENCHMARKS = (
+    ('listing', bench_listing),
+    ('template', bench_template),
+    ('slugs', bench_slugs),
+    ('copy', bench_copy),
+    ('usage', bench_usage),
+    ('transfer', bench_transfer),
+)
+
+
+def main():
+    options, args = parser.parse_args()
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+    only = options.only and options.only.split(',') or None
+
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory)
+        import django
+        from django.db import connection
+        from django.utils import simplejson
+        connection.use_debug_cursor = True
+        context = Context(options)
+
+        results = []
+        for group, benchmark in BENCHMARKS:
+            if only and group not in only:
+                continue
+            for name, params, result in benchmark(context):
+                result.update(name=name, params=params)
+                results.append(result)
+                sys.stderr.write('%s %s: %.4f s\n' % (
+                    name, params, result['median_seconds']))
+
+        output = simplejson.dumps({
+            'meta': {
+                'date': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': connection.cursor().execute(
+                    'SELECT sqlite_version()').fetchone()[0],
+                'platform': platform.platform(),
+                'repeat': options.repeat,
+            },
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options.output:
+            f = open(options.output, 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        else:
+            print output
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
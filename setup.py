@@ -4,6 +4,7 @@ import glob
 data = [ "locale/" + l.rsplit('/')[-1]+"/LC_MESSAGES/*.*"
          for l in glob.glob("attachments/locale/*.?o")]
 data.append('templates/attachments/*.html')
+data.append('sql/*.sql')
 
 setup(
     name='django-attachments',
@@ -15,6 +16,8 @@ setup(
     packages=[
         'attachments',
         'attachments.templatetags',
+        'attachments.management',
+        'attachments.management.commands',
     ],
     package_data={'attachments': data},
     classifiers=[